@@ -0,0 +1,79 @@
+"""Compare tiles/s of per tile conversion and metatile blocks.
+
+    python bench_metatile.py [<source png dir>] [--blocks 2,4] [--tiles 64]
+
+Uses the source pngs found below the directory (e.g. tiles/png of
+download.py) or generated test tiles. Only dither and encode are timed,
+in this process, no downloads.
+"""
+import argparse
+import glob
+import os
+import random
+import time
+from io import BytesIO
+from PIL import Image, ImageDraw
+from webservice import download
+
+
+def test_tile(seed):
+    rnd = random.Random(seed)
+    img = Image.new("RGB", (256, 256), (242, 239, 233))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        color = tuple(rnd.randrange(256) for _ in range(3))
+        box = sorted(rnd.randrange(256) for _ in range(2)), sorted(rnd.randrange(256) for _ in range(2))
+        draw.rectangle((box[0][0], box[1][0], box[0][1], box[1][1]), fill=color)
+    for _ in range(20):
+        draw.line([tuple(rnd.randrange(256) for _ in range(2)) for _ in range(3)],
+                  fill=(rnd.randrange(256),) * 3, width=rnd.randrange(1, 6))
+    out = BytesIO()
+    img.save(out, format="png")
+    return out.getvalue()
+
+
+def load_sources(folder, count):
+    files = [f for f in sorted(glob.glob(os.path.join(folder, "**", "*.png"), recursive=True))
+             if not f.endswith("_dt.png")] if folder else []
+    if not files:
+        return [test_tile(i) for i in range(count)]
+    sources = []
+    while len(sources) < count:
+        with open(files[len(sources) % len(files)], "rb") as f:
+            sources.append(f.read())
+    return sources
+
+
+def per_tile(sources):
+    for src in sources:
+        download.render_tile(src)
+
+
+def blocks(sources, n):
+    for i in range(0, len(sources), n * n):
+        chunk = sources[i:i + n * n]
+        download.render_block([((k % n, k // n), src) for k, src in enumerate(chunk)], n)
+
+
+def measure(name, func, count):
+    start = time.time()
+    func()
+    rate = count / (time.time() - start)
+    print("{:>12}: {:7.1f} tiles/s".format(name, rate))
+    return rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", nargs="?")
+    parser.add_argument("--blocks", default="2,4")
+    parser.add_argument("--tiles", type=int, default=64)
+    args = parser.parse_args()
+
+    sources = load_sources(args.folder, args.tiles)
+    # warm up the palette lookup table
+    download.render_tile(sources[0])
+    base = measure("per tile", lambda: per_tile(sources), len(sources))
+    for n in (int(b) for b in args.blocks.split(",")):
+        rate = measure("{0}x{0} blocks".format(n), lambda: blocks(sources, n), len(sources))
+        print("{:>12}  {:7.2f}x".format("", rate / base))
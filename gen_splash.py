@@ -12,12 +12,7 @@ epd = epd5in65f.EPD()
 img = Image.open("splash.png")
 # out = img.convert("RGB").quantize(method=None, palette=tile_pal).convert("RGB").filter(
 #    ImageFilter.EDGE_ENHANCE).filter(ImageFilter.SHARPEN).quantize(palette=eink_pal)
-out = img.convert("RGB").filter(ImageFilter.EDGE_ENHANCE)
-out_pixel = out.load()
-
-for px in range(img.size[0]):
-    for py in range(img.size[1]):
-        out_pixel[px, py] = pal.map_color(out_pixel[px, py], px, py)
+out = pal.dither(img.convert("RGB").filter(ImageFilter.EDGE_ENHANCE))
 
 out.save("splash_dt.png")
 
@@ -36,7 +31,7 @@ for x in range(2):
         # tile.save(name+".png")
 
         r = open(name+".raw", "w+b")
-        r.write(bytearray(epd.getbuffer(tile)))
+        r.write(epd.getbuffer_packed(tile))
         r.close()
 
         #z = open(name+".lz4", "w+b")
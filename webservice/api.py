@@ -1,17 +1,25 @@
 import gpx_converter
-from flask import Flask, jsonify, flash, request, redirect, make_response, url_for
+from flask import Flask, Response, jsonify, flash, request, redirect, make_response, url_for
 from werkzeug.utils import secure_filename
 import hashlib
-import requests
-from PIL import Image, ImageFilter
-from io import BytesIO
-import pal
-import epd5in65f
-from threading import Thread
-import redis
-import json
-from os import path
-r = redis.Redis('localhost')
+import hmac
+import math
+import zipfile
+import tilecache
+import fetcher
+import archive
+import trackfile
+from jobqueue import JobQueue
+from threading import Lock
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import database
+from os import environ, remove
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
 
 UPLOAD_FOLDER = './gpx'
 ALLOWED_EXTENSIONS = {'gpx'}
@@ -19,9 +27,19 @@ ALLOWED_EXTENSIONS = {'gpx'}
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['APPLICATION_ROOT'] = "/navi/api"
+# memory budget for hot tiles, optionally in a uWSGI cache shared by all workers
+app.config['TILE_LRU_BYTES'] = int(environ.get('TILE_LRU_BYTES', 64 * 1024 * 1024))
+app.config['TILE_LRU_UWSGI_CACHE'] = environ.get('TILE_LRU_UWSGI_CACHE')
+# archive jobs convert tiles in process, LOOPBACK fetches them from url_base instead
+app.config['ARCHIVE_WORKERS'] = int(environ.get('ARCHIVE_WORKERS', 4))
+app.config['ARCHIVE_LOOPBACK'] = False
+# jobs are run by worker.py
+app.config['JOB_QUEUE'] = environ.get('JOB_QUEUE', 'jobs')
+# token for the /admin endpoints, they are disabled without one
+app.config['ADMIN_TOKEN'] = environ.get('ADMIN_TOKEN')
 
+job_queue = JobQueue(app.config['JOB_QUEUE'])
 
-epd = epd5in65f.EPD()
 
 @app.route('/')
 def index():
@@ -56,19 +74,63 @@ def upload_file():
             return jsonify(error="No filename")
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            result = gpx_converter.convert(filename, file)
-            result['status'] = "false"
-            result['id'] = device_hash
-            #result['urls'] = json.dumps(result['urls'])
-            #result['wps'] = json.dumps(result['wps'])
-            resstr = json.dumps(result)
-            print(type(resstr))
-            r.hset(device_hash, "data", resstr)
-            r.hset(device_hash, "files", len(result['urls']))
-            r.hset(device_hash, "done", 0)
-            thread = Thread(target=run_download_task, args=(device_hash,))
-            thread.daemon = True
-            thread.start()
+            mode = request.form.get('mode', 'bbox')
+            if mode not in ('bbox', 'corridor'):
+                return jsonify(error="unknown mode "+mode)
+            try:
+                # buffer in tiles per zoom level, e.g. "16:4,13:2"
+                buffer = {int(z): int(b) for z, b in
+                          (item.split(':') for item in request.form.get('buffer', '').split(',') if item)}
+            except ValueError:
+                return jsonify(error="buffer must look like 16:4,13:2")
+            if any(not 0 <= b <= gpx_converter.max_buffer for b in buffer.values()):
+                return jsonify(error="buffer must be 0 to {} tiles".format(gpx_converter.max_buffer))
+            try:
+                tolerance = float(request.form['tolerance']) if 'tolerance' in request.form else None
+            except ValueError:
+                return jsonify(error="tolerance must be a number of meters")
+            if tolerance is not None and not (math.isfinite(tolerance) and tolerance >= 0):
+                return jsonify(error="tolerance must be a number of meters")
+            try:
+                result = gpx_converter.convert(filename, file, mode, buffer, tolerance)
+            except gpx_converter.TooManyTiles as e:
+                return jsonify(error="Track too large: {}".format(e))
+            except (ValueError, SyntaxError) as e:
+                return jsonify(error="Can not read GPX file: {}".format(e))
+            track_format = request.form.get('track_format', 'text')
+            if track_format not in ('text', 'binary'):
+                return jsonify(error="track_format must be text or binary")
+            spec = {'urls': [u['name'] for u in result['urls']], 'lon': result['wps']['lon'],
+                    'lat': result['wps']['lat'], 'track_format': track_format,
+                    'km': [u['km'] for u in result['urls']]}
+            key = archive_key(spec)
+            reuse = archive_complete(key, len(spec['urls']))
+            if reuse:
+                print("Reuse archive", key)
+            replaced = database.Job(device_hash)['archive']
+            with database.pipeline():
+                database.Job(device_hash).delete()
+                job = database.Job(device_hash, defaults={
+                    'status': "true" if reuse else "false",
+                    'files': len(spec['urls']),
+                    'done': len(spec['urls']) if reuse else 0,
+                    'archive': key,
+                    'mode': result['mode'],
+                    'tiles_saved': result['tiles_saved'],
+                    'points': result['points'],
+                    'points_kept': result['points_kept'],
+                    'track_format': track_format,
+                    'km_total': result['km'],
+                    'km_ready': result['km'] if reuse else 0,
+                })
+                job['lon'].set(spec['lon'])
+                job['lat'].set(spec['lat'])
+                job['urls'].extend(spec['urls'])
+                job['km'].set(spec['km'])
+                database.ref_archive(key)
+            release_archive(replaced)
+            if not reuse:
+                job_queue.enqueue(device_hash)
             return redirect(url_for('get_status', id=device_hash))
 
     return '''
@@ -79,57 +141,106 @@ def upload_file():
       <input type=file name=file>
       <input type=submit value=Upload>
       <input type=text name="device-id" value="1234567890">
+      <select name=mode><option>bbox</option><option>corridor</option></select>
     </form>
     '''
 
-@app.route('/tile/<z>/<x>/<y>.<ext>', methods=['GET'])
-def convert_tile(z,x,y,ext):
-    tile_file = "tiles/{z}_{x}_{y}.png".format(z=z, x=x, y=y)
-    print("get file:", tile_file)
-    if path.exists(tile_file):
-        print("cache hit")
-        out = Image.open(tile_file)
-    else:
-        print("cache miss")
-        url = "https://platinenmacher.tech/navi/tiles/{z}/{x}/{y}.png".format(z=z, x=x, y=y)
-        print("GET:", url)
-        req = requests.get(url)
-        if req.status_code != 200:
-            return jsonify(error="error while downloading")
-        t = Image.open(BytesIO(req.content))
-        out = t.convert("RGB").filter(ImageFilter.EDGE_ENHANCE)
+def raw_response(data, y):
+    response = make_response(data)
+    response.headers.set('Content-Type', 'application/x-binary')
+    response.headers.set(
+        'Content-Disposition', 'attachment', filename="{}.raw".format(y))
+    return response
 
-        out_pixel = out.load()
 
-        for px in range(t.size[0]):
-            for py in range(t.size[1]):
-                out_pixel[px, py] = pal.map_color(out_pixel[px, py], px, py)
-        
-        out.save(tile_file)
+class TileLRU:
+    '''
+    Tile payloads kept in memory, limited by their total size in bytes.
+    With a uWSGI cache name the payloads are stored in that cache instead,
+    shared by all workers (size and LRU purging are set in uwsgi.ini).
+    '''
+
+    def __init__(self, max_bytes, uwsgi_cache=None):
+        self.max_bytes = max_bytes
+        self.uwsgi_cache = uwsgi_cache if uwsgi is not None else None
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            if self.uwsgi_cache:
+                data = uwsgi.cache_get(key, self.uwsgi_cache)
+            else:
+                data = self.items.get(key)
+                if data is not None:
+                    self.items.move_to_end(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if self.uwsgi_cache:
+                uwsgi.cache_update(key, data, 0, self.uwsgi_cache)
+                return
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, old = self.items.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "items": len(self.items), "bytes": self.size, "max_bytes": self.max_bytes,
+                "uwsgi_cache": self.uwsgi_cache}
+
+
+tile_lru = TileLRU(app.config['TILE_LRU_BYTES'], app.config['TILE_LRU_UWSGI_CACHE'])
+
+
+@app.route('/tile/<int:z>/<int:x>/<int:y>.<ext>', methods=['GET'])
+def convert_tile(z,x,y,ext):
+    if ext not in ('png', 'raw'):
+        return jsonify(error="unknown tile format " + ext)
+    key = "{}/{}/{}.{}".format(z, x, y, ext)
+    data = tile_lru.get(key)
+    if data is None:
+        data = tilecache.load_tile(z, x, y, ext)
+        if data is None:
+            return jsonify(error="error while downloading")
+        tile_lru.put(key, data)
 
     print("Response for", ext)
     if ext == 'png':
-        img = BytesIO()
-        out.save(img, format='png')
-        response = make_response(img.getvalue())
+        response = make_response(data)
         response.headers.set('Content-Type', 'image/png')
         response.headers.set(
             'Content-Disposition', 'attachment', filename="{}.png".format(y))
         return response
-    if ext == 'raw':
-        response = make_response(bytearray(epd.getbuffer(out)))
-        response.headers.set('Content-Type', 'application/x-binary')
-        response.headers.set(
-            'Content-Disposition', 'attachment', filename="{}.raw".format(y))
-        return response
+    return raw_response(data, y)
+
+
+@app.route('/cache')
+def cache_stats():
+    return jsonify(tile_lru.stats())
 
 @app.route('/status/<id>')
 def get_status(id):
-    job = json.loads(r.hget(id, "data"))
-    files = int(r.hget(id, "files"))
-    files_done = int(r.hget(id, "done"))
-    if job:
-        return jsonify({"id":id, "status": job['status'], "files": files, "done": files_done, "url": "https://platinenmacher.tech"+url_for('static', filename=id+".zip")})
+    job = database.Job(id).load()
+    if 'status' in job:
+        key = job.get('archive', id)
+        return jsonify({"id":id, "status": job['status'], "files": job['files'], "done": job['done'], "tiles_saved": job.get('tiles_saved', 0), "points": job.get('points'), "points_kept": job.get('points_kept'), "km_total": job.get('km_total'), "km_ready": job.get('km_ready'), "url": "https://platinenmacher.tech"+url_for('static', filename=key+".zip")})
     else:
         return jsonify(error="Can not find job "+id)
 
@@ -151,27 +262,219 @@ def get_status(id):
 
 """
 
-from os import makedirs, getcwd, path
-import urllib.request
-import shutil
-import socket
-socket.setdefaulttimeout(300)
+def tile_key(name):
+    '''z, x, y of a job tile name {z}/{x}/{y}.raw'''
+    z, x, y = name.rsplit('.', 1)[0].split('/')
+    return z, x, y
+
+
+def load_job_tile(name):
+    '''Return the raw data of a job tile, None if it can not be converted'''
+    z, x, y = tile_key(name)
+    if app.config['ARCHIVE_LOOPBACK']:
+        url = gpx_converter.url_base + gpx_converter.url_template.format(z=z, x=x, y=y)
+        fetched = fetcher.get(url)
+        return fetched.content if fetched.status == 200 else None
+    return tilecache.load_tile(z, x, y, 'raw')
+
+
+def job_spec(job):
+    '''Tile names, track, track format and track distance of the tiles of a stored job'''
+    return {'urls': list(job['urls']), 'lon': job['lon'].get().tolist(), 'lat': job['lat'].get().tolist(),
+            'track_format': job['track_format'], 'km': job['km'].get().tolist()}
+
+
+def part_spec(spec, start, end):
+    '''The tiles of a job within start < km <= end of the track, start 0 includes km 0'''
+    if len(spec['km']) != len(spec['urls']):
+        # stored before tiles had a distance
+        return spec
+    keep = [i for i, km in enumerate(spec['km']) if (start < km or start == 0) and km <= end]
+    return dict(spec, urls=[spec['urls'][i] for i in keep], km=[spec['km'][i] for i in keep])
+
+
+def job_entries(spec, done=None):
+    '''
+    Yield the (name, data) archive entries of a job, tiles are converted on a thread pool.
+    done: called with the tile name after each tile entry was consumed
+    Raises RuntimeError when a tile can not be converted, an archive is never
+    published without all of its tiles.
+    '''
+    workers = app.config['ARCHIVE_WORKERS']
+    urls = iter(spec['urls'])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # convert at most 2 * workers tiles ahead of the consumer
+        window = deque((name, pool.submit(load_job_tile, name)) for name in islice(urls, 2 * workers))
+        try:
+            while window:
+                name, future = window.popleft()
+                data = future.result()
+                if data is None:
+                    raise RuntimeError("Can not convert tile " + name)
+                for next_name in islice(urls, 1):
+                    window.append((next_name, pool.submit(load_job_tile, next_name)))
+                yield "MAPS/"+name, data
+                if done:
+                    done(name)
+        finally:
+            for _, future in window:
+                future.cancel()
+    yield track_entry(spec)
+
+
+def track_entry(spec):
+    '''Name and data of the track file, text unless the job asked for binary'''
+    if spec['track_format'] == 'binary':
+        return "TRACK.BIN", trackfile.encode_binary(spec['lon'], spec['lat'])
+    return "TRACK", trackfile.encode_text(spec['lon'], spec['lat'])
+
+
+def archive_key(spec):
+    '''Content hash of a job archive, jobs with the same tiles and track share one archive'''
+    h = hashlib.sha1(tilecache.raw_cache_tag.encode())
+    for name in spec['urls']:
+        h.update(name.encode() + b"\n")
+    name, data = track_entry(spec)
+    h.update(name.encode() + b"\n" + data)
+    return h.hexdigest()
+
+
+def archive_file(key):
+    return "static/"+key+".zip"
+
+
+def archive_complete(key, files):
+    '''True if the archive of key exists and holds all files tiles'''
+    try:
+        with zipfile.ZipFile(archive_file(key)) as z:
+            return sum(1 for name in z.namelist() if name.startswith("MAPS/") and not name.endswith("/")) == files
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+def release_archive(key):
+    '''Drop the reference of a replaced job to the archive key, deletes it once no job uses it'''
+    if not key:
+        return
+    left = database.ref_archive(key, -1)
+    if left <= 0:
+        database.client.hdel(database.archive_refs, key)
+    # below 0 it was not counted, database.py migrate counts the existing jobs
+    if left == 0:
+        print("Delete archive", key)
+        try:
+            remove(archive_file(key))
+        except FileNotFoundError:
+            pass
+
+
+def verify_tiles(job):
+    '''
+    Drop tiles from the completion set of a job that are missing or damaged
+    in the tile store, returns the number of tiles still good.
+    '''
+    store = tilecache.tile_store()
+    tiles = job['tiles']
+    good = 0
+    for name in list(tiles):
+        z, x, y = tile_key(name)
+        if tilecache.cached_tile(store, z, x, y, 'raw') is None:
+            tiles.remove(name)
+        else:
+            good += 1
+    return good
+
+
 def run_download_task(id):
-    job = json.loads(r.hget(id, "data"))
-    print("Starte job", id)
-    for u in job['urls']:
-        tile_path = "gpx/"+id+"/MAPS/"+u['name']
-        makedirs(path.dirname(tile_path), exist_ok=True)
-        urllib.request.urlretrieve(u['uri'], tile_path)
-        r.hincrby(id, "done", 1)
-    tf = getcwd()+"/gpx/"+id
-    makedirs("gpx/"+id, exist_ok=True)
-    with open(tf+"/TRACK", 'w') as t:
-        for wp in job['wps']:
-            t.write("{} {}\n".format(wp['lon'], wp['lat']))
-    shutil.make_archive("static/"+id, "zip", "gpx/"+id)
-    job['status'] = "true"
-    r.hset(id, "data", json.dumps(job))
+    '''
+    Build the archive of a job. Can be run again after a crash, tiles in the
+    completion set of the job are read from the tile store, only the
+    others are converted, done counts each tile once.
+    '''
+    job = database.Job(id)
+    spec = job_spec(job)
+    key = job['archive']
+    if archive_complete(key, len(spec['urls'])):
+        # built by another job in the meantime
+        job['done'] = len(spec['urls'])
+    else:
+        good = 0 if app.config['ARCHIVE_LOOPBACK'] else verify_tiles(job)
+        job.update({'done': good, 'km_ready': 0})
+        print("Starte job", id, good, "of", len(spec['urls']), "tiles done")
+        # tiles come in order, once a tile of the last zoom level is in the
+        # archive everything up to its distance is
+        km = dict(zip(spec['urls'], spec['km']))
+        last_zoom = tile_key(spec['urls'][-1])[0] if spec['urls'] else None
+
+        def done(name):
+            if job['tiles'].add(name):
+                job.incr('done')
+            if name in km and tile_key(name)[0] == last_zoom:
+                job['km_ready'] = km[name]
+
+        archive.write_zip(archive_file(key), job_entries(spec, done))
+    job.update({'status': "true", 'km_ready': job['km_total']})
+
+
+def stalled_jobs():
+    '''Ids of unfinished jobs that are neither queued nor running'''
+    waiting = job_queue.ids()
+    for id in database.Job.ids():
+        if id not in waiting and database.Job(id)['status'] == "false":
+            yield id
+
+
+@app.route('/admin/requeue', methods=['POST'])
+@app.route('/admin/requeue/<id>', methods=['POST'])
+def requeue_jobs(id=None):
+    '''Queue stalled jobs again, or the job id (also a failed one)'''
+    # only as a header, query strings end up in access logs
+    token = app.config['ADMIN_TOKEN']
+    if not token or not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), token.encode()):
+        return jsonify(error="not allowed"), 403
+    expired = job_queue.requeue_expired()
+    for job_id, retry in expired.items():
+        if not retry:
+            database.Job(job_id)['status'] = "failed"
+    if id is not None:
+        job = database.Job(id)
+        if not job:
+            return jsonify(error="Can not find job "+id)
+        if id in job_queue.ids():
+            # a second run would share the lease of the first one
+            return jsonify(error="Job "+id+" is queued or running")
+        ids = [id]
+        job['status'] = "false"
+    else:
+        ids = list(stalled_jobs())
+    for job_id in ids:
+        job_queue.enqueue(job_id)
+    return jsonify(requeued=ids, expired=[job_id for job_id, retry in expired.items() if retry],
+                   failed=[job_id for job_id, retry in expired.items() if not retry])
+
+
+@app.route('/archive/<id>.zip')
+def stream_archive(id):
+    '''
+    Build the archive of a job on the fly from the tile store.
+    from and to (km along the track) select a part of the tiles, e.g. the
+    first to=20 km while the rest of the job is still converting.
+    '''
+    job = database.Job(id)
+    if not job:
+        return jsonify(error="Can not find job "+id)
+    try:
+        start = float(request.args.get('from', 0))
+        end = float(request.args.get('to', 'inf'))
+    except ValueError:
+        return jsonify(error="from and to must be km along the track")
+    spec = part_spec(job_spec(job), start, end)
+    response = Response(archive.stream_zip(job_entries(spec)), mimetype='application/zip')
+    filename = id if 'from' not in request.args and 'to' not in request.args \
+        else "{}_{:g}-{:g}".format(id, start, end)
+    response.headers.set(
+        'Content-Disposition', 'attachment', filename="{}.zip".format(filename))
+    return response
 
 if __name__ == "__main__":
     app.run(debug = True, threaded=True)
@@ -0,0 +1,82 @@
+"""Zip archives written entry by entry.
+
+ArchiveWriter appends each tile to the zip as soon as it is produced.
+stream_zip builds a zip on the fly and yields it in chunks, so an
+archive can be served without ever being written to disk.
+Tiles are dense raw data already, entries are stored uncompressed.
+"""
+import os
+import zipfile
+
+
+class ArchiveWriter:
+    '''Write (name, data) entries into a zip file, adding parent directory entries'''
+
+    def __init__(self, fileobj):
+        self.zip = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_STORED)
+        self.dirs = set()
+
+    def add(self, name, data):
+        parts = name.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            folder = "/".join(parts[:i]) + "/"
+            if folder not in self.dirs:
+                self.dirs.add(folder)
+                self.zip.writestr(folder, b"")
+        self.zip.writestr(name, data)
+
+    def close(self):
+        self.zip.close()
+
+
+def write_zip(filename, entries, progress=None):
+    '''
+    Write all (name, data) entries to filename.
+    The archive is written to a temp file and renamed when complete.
+    progress: called after each entry
+    '''
+    tmp = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            writer = ArchiveWriter(f)
+            try:
+                for name, data in entries:
+                    writer.add(name, data)
+                    if progress:
+                        progress(name)
+            finally:
+                writer.close()
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, filename)
+
+
+class _Chunks:
+    '''Write only file object collecting what the zip writer produced'''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(entries):
+    '''Yield a zip archive of all (name, data) entries chunk by chunk'''
+    out = _Chunks()
+    writer = ArchiveWriter(out)
+    for name, data in entries:
+        writer.add(name, data)
+        yield out.pop()
+    writer.close()
+    yield out.pop()
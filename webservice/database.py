@@ -0,0 +1,770 @@
+import base64
+import builtins
+import json
+import sys
+from array import array
+from typing import Dict
+from contextlib import contextmanager
+import threading
+import redis
+import os
+import ast
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# all objects share one client and its connection pool
+connection_pool = redis.ConnectionPool(host = 'localhost', decode_responses = True)
+client = redis.Redis(connection_pool = connection_pool)
+_local = threading.local()
+
+
+def legacy_decode(type, value):
+    '''Decode a value written with str() by older versions'''
+
+    if type == list or type == dict or type == tuple:
+        return type(ast.literal_eval(value))
+    if type == bool:
+        return value == 'True'
+    return type(value)
+
+
+def convert(type, value):
+    '''Bring a decoded value to the field type unless it already has it'''
+
+    if isinstance(type, builtins.type) and isinstance(value, type):
+        return value
+    return type(value)
+
+
+class JsonCodec(object):
+    '''Values as JSON text, the default codec'''
+
+    name = 'json'
+
+    def encode(self, value):
+        return json.dumps(value, default = str, separators = (',', ':'))
+
+    def decode(self, type, value):
+        if value is None:
+            return type()
+        if not isinstance(value, str):
+            # a reply redis parsed already, e.g. the (member, score) of ZREVRANGE
+            return convert(type, value)
+        try:
+            decoded = json.loads(value)
+        except (TypeError, ValueError):
+            return legacy_decode(type, value)
+        if type == str and not isinstance(decoded, str):
+            # a str() value that happens to be valid JSON, e.g. false
+            return value
+        return convert(type, decoded)
+
+
+class MsgpackCodec(object):
+    '''Values as base64 encoded msgpack, needs the msgpack package'''
+
+    name = 'msgpack'
+
+    def encode(self, value):
+        return base64.b64encode(msgpack.packb(value, default = str)).decode('ascii')
+
+    def decode(self, type, value):
+        if value is None:
+            return type()
+        if not isinstance(value, str):
+            return convert(type, value)
+        try:
+            decoded = msgpack.unpackb(base64.b64decode(value, validate = True))
+        except (TypeError, ValueError, msgpack.UnpackException):
+            return legacy_decode(type, value)
+        return convert(type, decoded)
+
+
+class FloatArrayCodec(object):
+    '''
+    Numeric sequences as base64 encoded little endian float64 values.
+    Decodes to array('d') unless a type is asked for.
+    '''
+
+    name = 'float64'
+
+    def encode(self, value):
+        values = array('d', value)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return base64.b64encode(values.tobytes()).decode('ascii')
+
+    def decode(self, type, value):
+        values = array('d')
+        if value is not None:
+            values.frombytes(base64.b64decode(value))
+            if sys.byteorder == 'big':
+                values.byteswap()
+        if type in (None, array):
+            return values
+        if type == list:
+            return values.tolist()
+        return type(values)
+
+
+codecs = {codec.name: codec for codec in (JsonCodec(), FloatArrayCodec())}
+if msgpack is not None:
+    codecs['msgpack'] = MsgpackCodec()
+
+# used by all objects that do not pick a codec themselves
+default_codec = codecs[os.environ.get('REDIS_CODEC', 'json')]
+
+
+@contextmanager
+def pipeline(transaction = True):
+    '''
+    Queue all redis commands of RedisObjects in this thread and send them
+    in one round trip (MULTI/EXEC if transaction) when the block ends.
+    Reads inside the block do not return values, use it for writes.
+    '''
+
+    if getattr(_local, 'pipeline', None) is not None:
+        # nested, the outer block executes
+        yield _local.pipeline
+        return
+    _local.pipeline = client.pipeline(transaction = transaction)
+    try:
+        yield _local.pipeline
+        _local.pipeline.execute()
+    finally:
+        _local.pipeline.reset()
+        _local.pipeline = None
+
+
+class RedisObject(object):
+    '''
+    A base object backed by redis.
+    Genrally, use RedisDict or RedisList rather than this directly.
+    '''
+
+    codec = None
+
+    def __init__(self, id = None, codec = None):
+        '''
+        Create or load a RedisObject.
+        codec: name or object of the value codec, default_codec if not set
+        '''
+
+        if codec is not None:
+            self.codec = codecs[codec] if isinstance(codec, str) else codec
+
+        if id:
+            self.id = id
+        else:
+            self.id = base64.urlsafe_b64encode(os.urandom(9)).decode('utf-8')
+
+        if ':' not in self.id:
+            self.id = self.__class__.__name__ + ':' + self.id
+
+    @property
+    def redis(self):
+        '''The pipeline of this thread if one is open, the shared client otherwise'''
+
+        return getattr(_local, 'pipeline', None) or client
+
+
+    def __bool__(self):
+        '''Test if an object currently exists'''
+
+        return bool(self.redis.exists(self.id))
+
+    def __eq__(self, other):
+        '''Tests if two redis objects are equal (they have the same key)'''
+
+        return self.id == other.id
+
+    def __str__(self):
+        '''Return this object as a string for testing purposes.'''
+
+        return self.id
+
+    def delete(self):
+        '''Delete this object from redis'''
+
+        self.redis.delete(self.id)
+
+    def decode(self, type, value):
+        '''Decode a value with the codec of this object, decode with no arguments if it is None'''
+
+        return (self.codec or default_codec).decode(type, value)
+
+    def encode(self, value):
+        '''Encode a value with the codec of this object'''
+
+        return (self.codec or default_codec).encode(value)
+
+    @staticmethod
+    def decode_value(type, value):
+        '''Decode a value with the default codec.'''
+
+        return default_codec.decode(type, value)
+
+    @staticmethod
+    def encode_value(value):
+        '''Encode a value with the default codec (JSON with default = str)'''
+
+        return default_codec.encode(value)
+
+
+
+def is_child(field_type):
+    '''True for field constructors made by as_child, they are stored in their own key'''
+
+    return getattr(field_type, 'child', False)
+
+
+class RedisDict(RedisObject):
+    '''An equivalent to dict where all keys/values are stored in Redis.'''
+
+    def __init__(self, id = None, fields = {}, defaults = None, codec = None):
+        '''
+        Create a new RedisObject
+        id: If specified, use this as the redis ID, otherwise generate a random ID.
+        fields: A map of field name to construtor used to read values from redis.
+            Objects will be written with json.dumps with default = str, so override __str__ for custom objects.
+            This should generally be set by the subobject's constructor.
+        defaults: A map of field name to values to store when constructing the object.
+        codec: name or object of the value codec, see RedisObject
+        '''
+
+        RedisObject.__init__(self, id, codec)
+
+        self.fields = fields
+
+        if defaults:
+            self.update(defaults)
+
+
+    @classmethod
+    def as_child(cls, parent, tag, item_type=None):
+        '''Alternative callable constructor that instead defines this as a child object'''
+        if item_type:
+            def helper(_ = None):
+                return cls(parent.id + ':' + tag, item_type)
+        else:
+            def helper(_=None):
+                return cls(parent.id + ':' + tag)
+        helper.child = True
+        return helper
+
+    def __getitem__(self, key):
+        '''
+        Load a field from this redis object.
+        Keys that were not specified in self.fields will raise an exception.
+        Keys that have not been set (either in defaults or __setitem__) will return the default for their type (if set)
+        '''
+
+        if key == 'id':
+            return self.id
+
+        if not key in self.fields:
+            raise KeyError('{} not found in {}'.format(key, self))
+
+        if is_child(self.fields[key]):
+            return self.fields[key]()
+
+        return self.decode(self.fields[key], self.redis.hget(self.id, key))
+
+    def __setitem__(self, key, val):
+        '''
+        Store a value in this redis object.
+        Keys that were not specified in self.fields will raise an exception.
+        Keys will be stored with json.dumps with a default of str, so override __str__ for custom objects.
+        '''
+
+        if not key in self.fields:
+            raise KeyError('{} not found in {}'.format(key, self))
+
+        self.redis.hset(self.id, key, self.encode(val))
+
+    def update(self, values):
+        '''Store several values with one HSET'''
+
+        for key in values:
+            if not key in self.fields:
+                raise KeyError('{} not found in {}'.format(key, self))
+
+        if values:
+            self.redis.hset(self.id, mapping = {
+                key: self.encode(val) for key, val in values.items()
+            })
+
+    def load(self):
+        '''
+        Return all values stored in the hash of this object with one HGETALL.
+        Child objects (lists, dicts) are not included.
+        '''
+
+        values = {'id': self.id.rsplit(':', 1)[-1]}
+        for key, val in self.redis.hgetall(self.id).items():
+            if key in self.fields:
+                values[key] = self.decode(self.fields[key], val)
+        return values
+
+    def incr(self, key, amount = 1):
+        '''Atomically add amount to an int field, returns the new value'''
+
+        if not key in self.fields:
+            raise KeyError('{} not found in {}'.format(key, self))
+
+        return self.redis.hincrby(self.id, key, amount)
+
+    def __iter__(self):
+        '''Return (key, val) pairs for all values stored in this RedisDict.'''
+
+        yield ('id', self.id.rsplit(':', 1)[-1])
+
+        keys = [key for key in self.fields if not is_child(self.fields[key])]
+        values = dict(zip(keys, self.redis.hmget(self.id, keys))) if keys else {}
+
+        for key in self.fields:
+            if key in values:
+                yield (key, self.decode(self.fields[key], values[key]))
+            else:
+                yield (key, self[key])
+
+
+class RedisList(RedisObject):
+    '''An equivalent to list where all items are stored in Redis.'''
+
+    def __init__(self, id = None, item_type = str, items = None, codec = None):
+        '''
+        Create a new RedisList
+        id: If specified, use this as the redis ID, otherwise generate a random ID.
+        item_type: The constructor to use when reading items from redis.
+        values: Default values to store during construction.
+        codec: name or object of the value codec, see RedisObject
+        '''
+
+        RedisObject.__init__(self, id, codec)
+
+        self.item_type = item_type
+
+        if items:
+            self.extend(items)
+
+    @classmethod
+    def as_child(cls, parent, tag, item_type):
+        '''Alternative callable constructor that instead defines this as a child object'''
+
+        def helper(_ = None):
+            return cls(parent.id + ':' + tag, item_type)
+
+        helper.child = True
+        return helper
+
+    def __getitem__(self, index):
+        '''
+        Load an item by index where index is either an int or a slice
+        Warning: this is O(n))
+        '''
+
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                raise NotImplementedError('Cannot specify a step to a RedisObject slice')
+
+            start = index.start or 0
+            if index.stop is None:
+                end = -1
+            elif index.stop == 0:
+                return []
+            else:
+                # LRANGE includes the end
+                end = index.stop - 1
+
+            return [
+                self.decode(self.item_type, el)
+                for el in self.redis.lrange(self.id, start, end)
+            ]
+        else:
+            return self.decode(self.item_type, self.redis.lindex(self.id, index))
+
+    def __setitem__(self, index, val):
+        '''Update an item by index
+        Warning: this is O(n)
+        '''
+
+        self.redis.lset(self.id, index, self.encode(val))
+
+    def __len__(self):
+        '''Return the size of the list.'''
+
+        return self.redis.llen(self.id)
+
+    def __delitem__(self, index):
+        '''Delete an item from a RedisList by index. (warning: this is O(n))'''
+
+        self.redis.lset(self.id, index, '__DELETED__')
+        self.redis.lrem(self.id, 1, '__DELETED__')
+
+    def __iter__(self):
+        '''Iterate over all items in this list.'''
+
+        for el in self.redis.lrange(self.id, 0, -1):
+            yield self.decode(self.item_type, el)
+
+    def lpop(self):
+        '''Remove and return a value from the left (low) end of the list.'''
+
+        return self.decode(self.item_type, self.redis.lpop(self.id))
+
+    def rpop(self):
+        '''Remove a value from the right (high) end of the list.'''
+
+        return self.decode(self.item_type, self.redis.rpop(self.id))
+
+    def lpush(self, val):
+        '''Add an item to the left (low) end of the list.'''
+
+        self.redis.lpush(self.id, self.encode(val))
+
+    def rpush(self, val):
+        '''Add an item to the right (high) end of the list.'''
+
+        self.redis.rpush(self.id, self.encode(val))
+
+    def append(self, val):
+        self.rpush(val)
+
+    def extend(self, values):
+        '''Add all values to the right (high) end of the list, in batches of 10000 per RPUSH.'''
+
+        values = [self.encode(val) for val in values]
+        for i in range(0, len(values), 10000):
+            self.redis.rpush(self.id, *values[i:i + 10000])
+
+    def toJson(self):
+        json.dumps(self.__iter__)
+
+
+class RedisSet(RedisObject):
+    '''An equivalent to set where all items are stored in Redis.'''
+
+    def __init__(self, id = None, item_type = str, items = None, codec = None):
+        '''
+        Create a new RedisSet
+        id: If specified, use this as the redis ID, otherwise generate a random ID.
+        item_type: The constructor to use when reading items from redis.
+        items: Default values to store during construction.
+        codec: name or object of the value codec, see RedisObject
+        '''
+
+        RedisObject.__init__(self, id, codec)
+
+        self.item_type = item_type
+
+        if items:
+            self.redis.sadd(self.id, *[self.encode(val) for val in items])
+
+    @classmethod
+    def as_child(cls, parent, tag, item_type):
+        '''Alternative callable constructor that instead defines this as a child object'''
+
+        def helper(_ = None):
+            return cls(parent.id + ':' + tag, item_type)
+
+        helper.child = True
+        return helper
+
+    def add(self, val):
+        '''Add an item, True if it was not in the set before'''
+
+        return self.redis.sadd(self.id, self.encode(val)) == 1
+
+    def remove(self, val):
+        '''Remove an item, True if it was in the set'''
+
+        return self.redis.srem(self.id, self.encode(val)) == 1
+
+    def __contains__(self, val):
+        return bool(self.redis.sismember(self.id, self.encode(val)))
+
+    def __len__(self):
+        return self.redis.scard(self.id)
+
+    def __iter__(self):
+        for el in self.redis.smembers(self.id):
+            yield self.decode(self.item_type, el)
+
+
+class RedisArray(RedisObject):
+    '''
+    A list of numbers stored packed in a single key (float64 codec),
+    reading 50k values is one GET and a memcpy instead of one value per item.
+    '''
+
+    codec = codecs['float64']
+
+    def __init__(self, id = None, items = None, codec = None):
+        '''
+        Create a new RedisArray
+        id: If specified, use this as the redis ID, otherwise generate a random ID.
+        items: Values to store during construction.
+        '''
+
+        RedisObject.__init__(self, id, codec)
+
+        if items is not None:
+            self.set(items)
+
+    @classmethod
+    def as_child(cls, parent, tag):
+        '''Alternative callable constructor that instead defines this as a child object'''
+
+        def helper(_ = None):
+            return cls(parent.id + ':' + tag)
+
+        helper.child = True
+        return helper
+
+    def get(self):
+        '''Return all values as array('d')'''
+
+        return self.decode(array, self.redis.get(self.id))
+
+    def set(self, values):
+        '''Replace all values'''
+
+        self.redis.set(self.id, self.encode(values))
+
+    def __getitem__(self, index):
+        return self.get()[index]
+
+    def __len__(self):
+        return len(self.get())
+
+    def __iter__(self):
+        return iter(self.get())
+
+
+
+class RedisToplist(RedisObject):
+    '''An equivalent to sorted list stored in redis'''
+
+    def __init__(self, id = None):
+        '''
+        Create a new RedisToplist
+        id: If specified, use this as the redis ID, otherwise generate a random ID.
+        '''
+
+        RedisObject.__init__(self, id)
+
+
+    def __getitem__(self, key):
+        '''
+        Load the rank from this redis object.
+        '''
+
+        return self.decode(int, self.redis.zrevrank(self.id, key))
+
+    def __setitem__(self, key, val):
+        '''Update an item by index
+        Warning: this is O(n)
+        '''
+
+        self.redis.zadd(self.id, {key: val})
+
+    def getTop(self):
+        ''' Get id and name of topmost player as tuple '''
+        return self.decode(tuple, self.redis.zrevrange(self.id, 0, 0, withscores=True)[0])
+
+    def getRank(self, player):
+        ''' Get Rank of player'''
+        return self[player]+1
+
+    def count(self):
+        '''Return the size of the list.'''
+
+        return self.redis.zcard(self.id)
+
+class Waypoint(RedisDict):
+    def __init__(self, id=None, lon=0, lat=0):
+        RedisDict.__init__(self, id=id, fields={
+        'lon': float,
+        'lat': float,
+    }, defaults={
+        'lon': lon,
+        'lat': lat,
+    })
+
+class Url(RedisDict):
+    def __init__(self, id=None, url=""):
+        RedisDict.__init__(self, id=id, fields={
+        'url': str,
+        'status': bool,
+    }, defaults= {
+        'url': url,
+        'status': False,
+    })
+    
+
+class Job(RedisDict):
+    '''
+    A tile archive job. Small status fields live in the job hash so a
+    status poll is one HGETALL, the track and tile lists are child keys.
+    '''
+
+    def __init__(self, id=None, defaults=None):
+        RedisDict.__init__(self,
+                                    id=id,
+                                    fields={
+                                        'status': str,
+                                        'files': int,
+                                        'done': int,
+                                        'archive': str,
+                                        'mode': str,
+                                        'tiles_saved': int,
+                                        'points': int,
+                                        'points_kept': int,
+                                        'track_format': str,
+                                        'km_total': float,
+                                        'km_ready': float,
+                                        'lon': RedisArray.as_child(self, 'lon'),
+                                        'lat': RedisArray.as_child(self, 'lat'),
+                                        'urls': RedisList.as_child(self, 'urls', str),
+                                        # distance along the track of each tile
+                                        'km': RedisArray.as_child(self, 'km'),
+                                        # names of the tiles that are converted and stored
+                                        'tiles': RedisSet.as_child(self, 'tiles', str),
+                                    },
+                                    defaults=defaults)
+
+    def delete(self):
+        '''Delete the job and its lists'''
+
+        for child in ('lon', 'lat', 'urls', 'km', 'tiles'):
+            self[child].delete()
+        RedisDict.delete(self)
+
+    @staticmethod
+    def ids():
+        '''Ids of all stored jobs (SCAN, use it for maintenance only)'''
+
+        for key in client.scan_iter('Job:*'):
+            if key.count(':') == 1:
+                yield key.split(':', 1)[1]
+
+
+# number of jobs using each archive, an archive nobody uses is deleted
+archive_refs = 'Archives'
+
+
+def ref_archive(key, count = 1):
+    '''Add count jobs using the archive key (negative to drop them), returns the jobs left'''
+
+    redis = getattr(_local, 'pipeline', None) or client
+    return redis.hincrby(archive_refs, key, count)
+
+
+def count_archives():
+    '''Count the jobs using each archive again (SCAN), returns the number of archives'''
+
+    counts = {}
+    for id in Job.ids():
+        key = Job(id)['archive']
+        if key:
+            counts[key] = counts.get(key, 0) + 1
+    with pipeline() as pipe:
+        pipe.delete(archive_refs)
+        if counts:
+            pipe.hset(archive_refs, mapping = counts)
+    return len(counts)
+
+
+def migrate_hash(obj):
+    '''Rewrite the hash fields of a RedisDict with its codec, returns the number changed'''
+
+    values = {}
+    for key, raw in obj.redis.hgetall(obj.id).items():
+        if key in obj.fields and not is_child(obj.fields[key]):
+            encoded = obj.encode(obj.decode(obj.fields[key], raw))
+            if encoded != raw:
+                values[key] = encoded
+    if values:
+        obj.redis.hset(obj.id, mapping = values)
+    return len(values)
+
+
+def migrate_list(obj):
+    '''Rewrite all items of a RedisList with its codec, returns the number changed'''
+
+    raw = obj.redis.lrange(obj.id, 0, -1)
+    encoded = [obj.encode(obj.decode(obj.item_type, el)) for el in raw]
+    changed = sum(1 for a, b in zip(raw, encoded) if a != b)
+    if changed:
+        with pipeline():
+            obj.delete()
+            obj.extend(obj.decode(obj.item_type, el) for el in encoded)
+    return changed
+
+
+def migrate_array(obj):
+    '''Turn a RedisList of numbers into a RedisArray, returns the number of values'''
+
+    if client.type(obj.id) != 'list':
+        return 0
+    values = [float(el) for el in client.lrange(obj.id, 0, -1)]
+    with pipeline():
+        obj.delete()
+        obj.set(values)
+    return len(values)
+
+
+def migrate_blob_job(id):
+    '''Turn a job stored as JSON in the "data" field of <device hash> into a Job'''
+
+    old = client.hgetall(id)
+    data = json.loads(old['data'])
+    wps = data['wps']
+    if isinstance(wps, list):
+        # as stored by the first versions, one {"lon", "lat"} per point
+        wps = {'lon': [wp['lon'] for wp in wps], 'lat': [wp['lat'] for wp in wps]}
+    with pipeline() as pipe:
+        Job(id).delete()
+        job = Job(id, defaults = {
+            'status': data.get('status', "true"),
+            'files': int(old.get('files', len(data['urls']))),
+            'done': int(old.get('done', 0)),
+            'archive': id,
+            'mode': data.get('mode', 'bbox'),
+            'tiles_saved': data.get('tiles_saved', 0),
+            'points': len(wps['lon']),
+            'points_kept': len(wps['lon']),
+            'track_format': 'text',
+        })
+        job['lon'].set(wps['lon'])
+        job['lat'].set(wps['lat'])
+        job['urls'].extend(url['name'] for url in data['urls'])
+        pipe.delete(id)
+
+
+def migrate(pattern = '*'):
+    '''Bring all jobs matching pattern to the current key layout and codecs'''
+
+    for key in client.scan_iter(pattern):
+        if client.type(key) != 'hash':
+            continue
+        if key.startswith('Job:') and key.count(':') == 1:
+            job = Job(key)
+            changed = migrate_hash(job)
+            changed += migrate_array(job['lon']) + migrate_array(job['lat'])
+            changed += migrate_list(job['urls'])
+            print(key, changed, "values migrated")
+        elif ':' not in key and client.hexists(key, 'data'):
+            migrate_blob_job(key)
+            print(key, "migrated to Job:" + key)
+    print(count_archives(), "archives in use")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: database.py migrate [<key pattern>]")
+        sys.exit(1)
+    migrate(*sys.argv[2:3])
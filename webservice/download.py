@@ -1,14 +1,20 @@
 import os
 import math
-import urllib.request
+import json
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
 from PIL import Image, ImageFilter, ImageOps
 from . import pal
 from . import epd5in65f
+from . import fetcher
+from . import metatile
+from . import tilestore
 import lz4.frame
-from multiprocessing import Pool
 
 
-url_template = "https://c.tile.openstreetmap.de/{z}/{x}/{y}.png"
+url_template = os.environ.get("TILE_URL", "https://c.tile.openstreetmap.de/{z}/{x}/{y}.png")
 epd = epd5in65f.EPD()
 eink_pal = Image.new("P", (1, 1), 0)
 eink_pal.putpalette(pal.generate_eink())
@@ -18,6 +24,15 @@ total = 0
 done = 0
 percent = 0
 
+# get_tiles pipeline: parallel downloads, dither processes and the number
+# of tiles that may wait in front of the dither and the write stage
+fetch_workers = 8
+render_processes = 6
+render_depth = 12
+write_depth = 12
+# dither blocks of n x n tiles as one image (no seams at tile borders)
+metatile_size = 1
+
 
 def lon2tile(lon, zoom):
     return math.floor(((lon + 180) / 360) * math.pow(2, zoom))
@@ -27,61 +42,197 @@ def lat2tile(lat, zoom):
     return math.floor(((1 - math.log(math.tan((lat * math.pi) / 180) + 1 / math.cos((lat * math.pi) / 180)) / math.pi) / 2) * math.pow(2, zoom))
 
 
-def get_tiles(lon, lat, zoom, margin):
+def get_tiles(lon, lat, zoom, margin, pack=None):
     jobs = []
     for z in zoom:
-        jobs.extend(get_jobs_for(lon, lat, z, margin))
+        jobs.extend(get_jobs_for(lon, lat, z, margin, pack))
+
+    asyncio.run(run_pipeline(jobs))
 
+
+async def run_pipeline(jobs, fetchers=None, processes=None, depth=None, block=None):
+    '''
+    Convert all jobs in three overlapping stages:
+    fetch (threads) -> dither + encode (process pool) -> write (this process).
+    The bounded queues between the stages hold depth["render"] and
+    depth["write"] tiles (blocks with metatiles), a full queue stops the
+    stage in front of it.
+    block: convert blocks of block x block tiles as one image, metatile_size by default
+    '''
+    fetchers = fetchers or fetch_workers
+    processes = processes or render_processes
+    depth = dict({"render": render_depth, "write": write_depth}, **(depth or {}))
+    n = block or metatile_size
+    loop = asyncio.get_running_loop()
+    render_q = asyncio.Queue(maxsize=depth["render"])
+    write_q = asyncio.Queue(maxsize=depth["write"])
+    pending = iter(job_blocks(jobs, n))
     total = len(jobs)
 
-    with Pool(processes=6) as pool:
+    async def fetch_job(io_pool, job):
+        try:
+            src, validators = await loop.run_in_executor(io_pool, load_source, job)
+        except Exception as e:
+            print("{0} failed: {1}".format(job.get("url"), e))
+            return None
+        if src is None:
+            print("{0} failed: {1}".format(job.get("url"), validators))
+            return None
+        return job, src, validators
+
+    async def fetch(io_pool):
+        for block_jobs in pending:
+            fetched = await asyncio.gather(*[fetch_job(io_pool, job) for job in block_jobs])
+            fetched = [item for item in fetched if item is not None]
+            if fetched:
+                await render_q.put(fetched)
+
+    async def render(cpu_pool):
+        while True:
+            batch = await render_q.get()
+            if batch is None:
+                return
+            try:
+                if n == 1:
+                    tiles = [await loop.run_in_executor(cpu_pool, render_tile, batch[0][1])]
+                else:
+                    cells = [((job.get("x") % n, job.get("y") % n), src) for job, src, _ in batch]
+                    tiles = await loop.run_in_executor(cpu_pool, render_block, cells, n)
+            except Exception as e:
+                print("{0} failed: {1}".format(batch[0][0].get("url"), e))
+                continue
+            await write_q.put([item + tile for item, tile in zip(batch, tiles)])
+
+    async def write(io_pool):
         done = 0
-        ret = pool.imap(process_image, jobs)
-        for txt in ret:
-            done += 1
-            print("({0:1.2f}%): {1}".format(100*done/total, txt))
-        pool.close()
+        start = time.time()
+        while True:
+            batch = await write_q.get()
+            if batch is None:
+                return
+            for item in batch:
+                done += 1
+                try:
+                    txt = await loop.run_in_executor(io_pool, store_tile, *item)
+                except Exception as e:
+                    print("{0} failed: {1}".format(item[0].get("url"), e))
+                    continue
+                print("({0:1.2f}%, {1:.1f} tiles/s): {2}".format(
+                    100*done/total, done/(time.time()-start), txt))
 
+    with ThreadPoolExecutor(max_workers=fetchers) as io_pool, \
+            ThreadPoolExecutor(max_workers=1) as write_pool, \
+            ProcessPoolExecutor(max_workers=processes) as cpu_pool:
+        writer = asyncio.ensure_future(write(write_pool))
+        renderers = [asyncio.ensure_future(render(cpu_pool)) for _ in range(processes)]
+        await asyncio.gather(*[fetch(io_pool) for _ in range(fetchers)])
+        for _ in renderers:
+            await render_q.put(None)
+        await asyncio.gather(*renderers)
+        await write_q.put(None)
+        await writer
 
-def process_image(job):
-    os.makedirs(job.get("img_folder"), exist_ok=True)
-    os.makedirs(job.get("job_folder"), exist_ok=True)
-    os.makedirs(job.get("lz4_folder"), exist_ok=True)
-    # load images from server if not in cache
-    url = "local"
-    if job.get("url") is None:
-        return "skip"
-    if not os.path.isfile((job.get("img_folder")+job.get("img_file"))):
-        urllib.request.urlretrieve(job.get("url"), job.get(
-            "img_folder")+job.get("img_file"))
-        url = job.get("url")
-    t = Image.open(job.get("img_folder")+job.get("img_file"))
+
+def job_blocks(jobs, n):
+    '''Group jobs into the n x n blocks they belong to, in the order of their first job'''
+    blocks = {}
+    for job in jobs:
+        bx, by = metatile.origin(job.get("x"), job.get("y"), n)
+        blocks.setdefault((job.get("z"), bx, by), []).append(job)
+    return list(blocks.values())
+
+
+def load_source(job):
+    '''
+    Source png of a job from the tile cache or downloaded.
+    Returns (png, validators), validators is None for a cached png and the
+    http status instead of the png if the download failed.
+    '''
+    if job.get("pack"):
+        src = tile_pack(job.get("pack")).get(job.get("z"), job.get("x"), job.get("y"), "src.png")
+        if src is not None:
+            return bytes(src), None
+    elif os.path.isfile(job.get("img_folder")+job.get("img_file")):
+        with open(job.get("img_folder")+job.get("img_file"), "rb") as f:
+            return f.read(), None
+    fetched = fetcher.get(job.get("url"))
+    if fetched.status != 200:
+        return None, fetched.status
+    return fetched.content, fetched.validators
+
+
+def render_tile(src):
+    '''Dither and encode a source png, returns the dithered png and the raw data'''
+    t = Image.open(BytesIO(src))
     # use quantize functions instead of PIL quantize
-    out = t.convert("RGB").filter(ImageFilter.EDGE_ENHANCE_MORE)
+    out = pal.dither(t.convert("RGB").filter(ImageFilter.EDGE_ENHANCE_MORE))
+    img = BytesIO()
+    out.save(img, format="png")
+    return img.getvalue(), epd.getbuffer_packed(out)
 
-    out_pixel = out.load()
 
-    for px in range(t.size[0]):
-        for py in range(t.size[1]):
-            out_pixel[px, py] = pal.map_color(out_pixel[px, py], px, py)
+def render_block(cells, n):
+    '''
+    Dither and encode the tiles of a n x n block as one image.
+    cells: [((dx, dy), png)], returns [(dithered png, raw data)] in that order
+    '''
+    mosaic = metatile.stitch(dict(cells), n)
+    out = pal.dither(mosaic.filter(ImageFilter.EDGE_ENHANCE_MORE))
+    tiles = []
+    for tile in metatile.split(out, [cell for cell, _ in cells]):
+        img = BytesIO()
+        tile.save(img, format="png")
+        tiles.append((img.getvalue(), epd.getbuffer_packed(tile)))
+    return tiles
 
-    out.save(job.get("img_folder") +
-             job.get("img_file").replace(".png", "_dt.png"))
 
-    # lz4 compress raw image
-    #z = open((job.get("lz4_folder")+job.get("img_file")
-    #          ).split(".")[0]+".lz4", "w+b")
-    #z.write(lz4.frame.compress(bytearray(epd.getbuffer(out))))
-    #z.close()
+def store_tile(job, src, validators, png, raw):
+    '''Write the results of a job, the source too if it was downloaded'''
+    url = "local" if validators is None else job.get("url")
+    if job.get("pack"):
+        pack = tile_pack(job.get("pack"))
+        z, x, y = job.get("z"), job.get("x"), job.get("y")
+        if validators is not None:
+            pack.put(z, x, y, "src.png", src)
+            pack.put(z, x, y, "src.meta", json.dumps(validators).encode())
+        pack.put(z, x, y, "dt.png", png)
+        pack.put(z, x, y, "raw", raw)
+        return("{0} -> {1}:{2}/{3}/{4}".format(url, job.get("pack"), z, x, y))
 
-    r = open((job.get("job_folder")+job.get("img_file")
-              ).split(".")[0]+".raw", "w+b")
-    r.write(bytearray(epd.getbuffer(out)))
-    r.close()
+    os.makedirs(job.get("img_folder"), exist_ok=True)
+    os.makedirs(job.get("job_folder"), exist_ok=True)
+    if validators is not None:
+        with open(job.get("img_folder")+job.get("img_file"), "wb") as f:
+            f.write(src)
+    with open(job.get("img_folder")+job.get("img_file").replace(".png", "_dt.png"), "wb") as f:
+        f.write(png)
+    with open((job.get("job_folder")+job.get("img_file")).split(".")[0]+".raw", "wb") as f:
+        f.write(raw)
     return("{0} -> {1}".format(url, job.get("img_folder")+job.get("img_file")))
 
 
-def get_jobs_for(lon, lat, zoom, margin):
+_packs = {}
+
+
+def tile_pack(filename):
+    # open the pack once per worker process
+    key = (os.getpid(), filename)
+    if key not in _packs:
+        _packs[key] = tilestore.TilePack(filename)
+    return _packs[key]
+
+
+def process_image(job):
+    '''Fetch, convert and store a single job'''
+    if job.get("url") is None:
+        return "skip"
+    src, validators = load_source(job)
+    if src is None:
+        return "{0} failed: {1}".format(job.get("url"), validators)
+    return store_tile(job, src, validators, *render_tile(src))
+
+
+def get_jobs_for(lon, lat, zoom, margin, pack=None):
 
     # generate tile limits for download
     x = [lon2tile(lon[0], zoom), lon2tile(lon[1], zoom)]
@@ -111,7 +262,8 @@ def get_jobs_for(lon, lat, zoom, margin):
             lz4_folder = "tiles/lz4/{z}/{x}/".format(z=zoom, x=x[0]+dx)
             img_file = "{y}.png".format(z=zoom, x=x[0]+dx, y=y[0]+dy)
             jobs.append({"url": url, "lz4_folder": lz4_folder, "job_folder": job_folder,
-                        "img_folder": img_folder, "img_file": img_file})
+                        "img_folder": img_folder, "img_file": img_file,
+                        "z": zoom, "x": x[0]+dx, "y": y[0]+dy, "pack": pack})
     print('Jobs: {0}'.format(len(jobs)))
     return jobs
 
@@ -135,6 +287,6 @@ def convert_to_c_file(filename):
     c_file.close()
 
 
-def get_map(lon, lat, zoom, jobfolder, margin):
-    get_tiles(lon, lat, zoom, margin)
+def get_map(lon, lat, zoom, jobfolder, margin, pack=None):
+    get_tiles(lon, lat, zoom, margin, pack)
     # zip up all the raw files for download
@@ -30,10 +30,13 @@
 #
 
 import logging
+import numpy
 
 # Display resolution
 EPD_WIDTH       = 600
 EPD_HEIGHT      = 448
+# bump when the packed buffer format changes, invalidates cached .raw tiles
+ENCODER_VERSION = 1
 
 class EPD:
     def __init__(self):
@@ -155,6 +158,43 @@ class EPD:
                         
         return buf
 
+    # RGB value -> 4 bit color code, anything else is 7 (clean)
+    COLOR_CODES = [
+        ((0, 0, 0), 0),
+        ((255, 255, 255), 1),
+        ((0, 255, 0), 2),
+        ((0, 0, 255), 3),
+        ((255, 0, 0), 4),
+        ((255, 255, 0), 5),
+        ((255, 128, 0), 6),
+    ]
+
+    def color_codes(self, rgb):
+        """Map an (..., 3) RGB array to color codes"""
+        rgb = numpy.asarray(rgb, dtype=numpy.uint32)
+        rgb = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+        codes = numpy.full(rgb.shape, 7, dtype=numpy.uint8)
+        for (r, g, b), code in self.COLOR_CODES:
+            codes[rgb == (r << 16) | (g << 8) | b] = code
+        return codes
+
+    def getbuffer_packed(self, image):
+        """Same encoding as getbuffer, packed with numpy and returned as bytes.
+        "P" mode images are mapped through their palette without converting to RGB.
+        """
+        imwidth, imheight = image.size
+        if imwidth % 2:
+            # odd rows shift the nibble order, keep the reference path
+            return bytes(bytearray(self.getbuffer(image)))
+        if image.mode == "P":
+            pal = image.getpalette() or []
+            pal = numpy.array(pal + [0] * (768 - len(pal)), dtype=numpy.uint8)
+            codes = self.color_codes(pal.reshape(256, 3))[numpy.asarray(image)]
+        else:
+            codes = self.color_codes(numpy.asarray(image.convert('RGB')))
+        codes = codes.reshape(-1, 2)
+        return ((codes[:, 0] << 4) | codes[:, 1]).tobytes()
+
     def display(self,image):
         self.send_command(0x61)#Set Resolution setting
         self.send_data(0x02)
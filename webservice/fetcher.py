@@ -0,0 +1,111 @@
+"""Upstream tile downloads shared by the web service and download.py.
+
+One requests session per process keeps connections to the tile servers
+alive (pool size FETCH_POOL). At most FETCH_PER_HOST requests run at the
+same time per host, the others wait. Connection errors, timeouts, 429
+and 5xx answers are retried FETCH_RETRIES times with exponential backoff
+(or the Retry-After of the server, at most the longest backoff). Passing
+the validators of a cached copy makes the request conditional, a 304
+answer means it is current.
+
+Tile URLs are plain templates, point TILE_URL at a local server to test.
+"""
+import random
+import threading
+import time
+from collections import namedtuple
+from os import environ, getpid
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# status 304: the cached copy is current, content is empty
+Fetched = namedtuple("Fetched", "status content validators")
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class Fetcher:
+    '''Pooled, per host limited and retrying HTTP GET'''
+
+    def __init__(self, per_host=4, pool=16, retries=3, backoff=0.5, timeout=(10, 60)):
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = "IndiaNavi-Converter"
+        adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host_slots(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+    def get(self, url, validators=None):
+        '''
+        GET url, returns Fetched(status, content, validators).
+        validators: {"etag", "last_modified"} of a cached copy
+        Raises requests.RequestException when the last attempt failed
+        without an answer.
+        '''
+        headers = {}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        for attempt in range(self.retries + 1):
+            wait = self.backoff * 2 ** attempt * (1 + random.random())
+            try:
+                with self.host_slots(url):
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                print("GET failed, retry", url)
+                time.sleep(wait)
+                continue
+            if response.status_code in RETRY_STATUS and attempt < self.retries:
+                retry_after = response.headers.get("Retry-After", "")
+                print("GET", response.status_code, "retry", url)
+                if retry_after.isdigit():
+                    # callers may hold a tile lock, wait no longer than the longest backoff
+                    wait = min(float(retry_after), self.backoff * 2 ** self.retries * 2)
+                time.sleep(wait)
+                continue
+            break
+
+        if response.status_code == 304:
+            return Fetched(304, b"", validators)
+        return Fetched(response.status_code, response.content, {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        })
+
+
+_fetcher = None
+
+
+def fetcher():
+    '''The Fetcher of this process, sessions are not shared with forked workers'''
+    global _fetcher
+    if _fetcher is None or _fetcher[0] != getpid():
+        _fetcher = (getpid(), Fetcher(
+            per_host=int(environ.get("FETCH_PER_HOST", 4)),
+            pool=int(environ.get("FETCH_POOL", 16)),
+            retries=int(environ.get("FETCH_RETRIES", 3)),
+            timeout=(10, float(environ.get("FETCH_TIMEOUT", 60)))))
+    return _fetcher[1]
+
+
+def get(url, validators=None):
+    return fetcher().get(url, validators)
@@ -1,7 +1,8 @@
 from os import write, mkdir
-import gpxpy
-import gpxpy.gpx
 import math
+import numpy
+import gpx_reader
+import trackfile
 
 url_base = "https://platinenmacher.tech/navi/api"
 url_template = "/tile/{z}/{x}/{y}.raw"
@@ -12,63 +13,189 @@ def lon2tile(lon, zoom):
 
 
 def lat2tile(lat, zoom):
+    lat = min(max(lat, -gpx_reader.max_latitude), gpx_reader.max_latitude)
     return math.floor(((1 - math.log(math.tan((lat * math.pi) / 180) + 1 / math.cos((lat * math.pi) / 180)) / math.pi) / 2) * math.pow(2, zoom))
 
 
-def get_jobs_for(lon, lat, zoom):
+def bbox_limits(lon, lat, zoom):
     # generate tile limits for area
     x = [lon2tile(lon[0], zoom), lon2tile(lon[1], zoom)]
     y = [lat2tile(lat[0], zoom), lat2tile(lat[1], zoom)]
 
     # switch if reversed
     if y[0] > y[1]:
-        a = y[0]
-        y[1] = y[0]
-        y[0] = a
+        y[1],y[0] = y[0],y[1]
 
     if x[0] > x[1]:
-        a = x[0]
-        x[1] = x[0]
-        x[0] = a
+        x[1],x[0] = x[0],x[1]
 
     # add tiles to the limits
     x[1] += 10
     x[0] -= 10
     y[1] += 10
     y[0] -= 10
+    return x, y
+
+
+def tile_job(zoom, x, y):
+    url = url_base + url_template.format(z=zoom, x=x, y=y)
+    return {'uri': url, 'name': "{z}/{x}/{y}.raw".format(z=zoom, x=x, y=y), 'z': zoom, 'x': x, 'y': y}
 
+
+def get_jobs_for(lon, lat, zoom):
+    x, y = bbox_limits(lon, lat, zoom)
     jobs = []
     for dx in range(abs(x[1]-x[0])):
         for dy in range(abs(y[1]-y[0])):
-            url = url_base + url_template.format(z=zoom, x=x[0]+dx, y=y[0]+dy)
-            jobs.append({'uri':url,'name':"{z}/{x}/{y}.raw".format(z=zoom, x=x[0]+dx, y=y[0]+dy)})
+            jobs.append(tile_job(zoom, x[0]+dx, y[0]+dy))
     return jobs
 
 
-def convert(filename, data_file):
+def count_jobs_for(lon, lat, zoom):
+    x, y = bbox_limits(lon, lat, zoom)
+    return abs(x[1]-x[0]) * abs(y[1]-y[0])
+
+
+def count_corridor_min(lon, lat, zoom, buffer):
+    '''Fewest tiles a corridor around a track with these bounds can have'''
+    x, y = sorted(lon2tile(l, zoom) for l in lon), sorted(lat2tile(l, zoom) for l in lat)
+    # every tile row (column) it spans has 2 * buffer + 1 tiles at least
+    return (max(x[1] - x[0], y[1] - y[0]) + 1 + 2 * buffer) * (2 * buffer + 1)
+
+
+def track_samples(lons, lats, zoom, per_tile=4):
+    '''
+    Points along the track in tile coordinates, at least per_tile on every
+    tile it crosses, and their distance along the track in km.
+    '''
+    fx = gpx_reader.lon2tilef(lons, zoom)
+    fy = gpx_reader.lat2tilef(lats, zoom)
+    dx = numpy.diff(fx)
+    dy = numpy.diff(fy)
+    steps = (per_tile * numpy.maximum(numpy.abs(dx), numpy.abs(dy))).astype(numpy.int64) + 1
+    segment = numpy.repeat(numpy.arange(len(steps)), steps)
+    f = (numpy.arange(len(segment)) - numpy.repeat(numpy.cumsum(steps) - steps, steps) + 1) / steps[segment]
+    mx, my = trackfile.to_meters(lons, lats)
+    length = numpy.hypot(numpy.diff(mx), numpy.diff(my))
+    along = numpy.concatenate([[0], numpy.cumsum(length)])
+    return (numpy.concatenate([fx[:1], fx[segment] + dx[segment] * f]),
+            numpy.concatenate([fy[:1], fy[segment] + dy[segment] * f]),
+            numpy.concatenate([[0], along[segment] + length[segment] * f]) / 1000)
+
+
+def get_corridor_jobs_for(lons, lats, zoom, buffer):
+    '''Tiles within `buffer` tiles of the track polyline'''
+    return [tile_job(zoom, int(x), int(y)) for x, y in corridor_tiles(lons, lats, zoom, buffer)]
+
+
+def corridor_tiles(lons, lats, zoom, buffer):
+    '''(x, y) array of the tiles within `buffer` tiles of the track polyline'''
+    # sample every segment at least every quarter tile
+    sx, sy, _ = track_samples(lons, lats, zoom)
+    x = numpy.floor(sx).astype(numpy.int64)
+    y = numpy.floor(sy).astype(numpy.int64)
+    track = numpy.unique(numpy.stack([x, y], axis=1), axis=0)
+
+    offsets = numpy.arange(-buffer, buffer + 1)
+    ox, oy = numpy.meshgrid(offsets, offsets, indexing="ij")
+    tiles = (track[:, None, :] + numpy.stack([ox.ravel(), oy.ravel()], axis=1)[None, :, :]).reshape(-1, 2)
+    return numpy.unique(tiles, axis=0)
+
+
+def order_jobs(jobs, lons, lats):
+    '''
+    Order tile jobs so the device gets what it needs first: the lower zoom
+    levels (overview) before the higher ones, each level by the distance
+    along the track where it first enters the track tile nearest to the tile.
+    That distance is added to every job as 'km'.
+    '''
+    ordered = []
+    for zoom in sorted({job['z'] for job in jobs}):
+        level = [job for job in jobs if job['z'] == zoom]
+        sx, sy, km = track_samples(lons, lats, zoom)
+        # the first sample on each tile the track crosses, their number
+        # follows the track length in tiles, not its number of points
+        cells = numpy.stack([numpy.floor(sx), numpy.floor(sy)], axis=1)
+        first = numpy.lexsort((km, cells[:, 1], cells[:, 0]))
+        cells = cells[first]
+        start = numpy.ones(len(cells), dtype=bool)
+        start[1:] = numpy.any(cells[1:] != cells[:-1], axis=1)
+        first = first[start]
+        cx, cy, km = sx[first], sy[first], km[first]
+        tx = numpy.array([job['x'] for job in level]) + 0.5
+        ty = numpy.array([job['y'] for job in level]) + 0.5
+        # nearest track tile, in chunks of about 4M distances
+        chunk = max(1, 4000000 // len(cx))
+        nearest = numpy.concatenate([
+            numpy.argmin((tx[i:i + chunk, None] - cx[None, :]) ** 2 + (ty[i:i + chunk, None] - cy[None, :]) ** 2, axis=1)
+            for i in range(0, len(level), chunk)]) if level else []
+        for job, n in zip(level, nearest):
+            job['km'] = round(float(km[n]), 3)
+        ordered += sorted(level, key=lambda job: job['km'])
+    return ordered
+
+
+# tiles around the track in corridor mode per zoom level
+corridor_buffer = {16: 4, 13: 2}
+# widest corridor a job may ask for, the padding of bbox mode
+max_buffer = 10
+# most tiles of one job (about 1.6 GB of raw tiles)
+max_tiles = 50000
+
+
+class TooManyTiles(ValueError):
+    '''The tiles of a track exceed max_tiles'''
+
+
+# default simplification of the stored track in meters
+track_tolerance = 2.0
+
+
+def convert(filename, data_file, mode="bbox", buffer=None, tolerance=None):
+    '''
+    Read a GPX file and list its waypoints and the tiles to load.
+    mode: "bbox" loads the padded bounding box of the track,
+          "corridor" only tiles within buffer[zoom] tiles of the track
+    tolerance: simplify the stored track to this many meters, 0 keeps all points
+    The tiles are ordered for the device, see order_jobs. Raises TooManyTiles
+    for a job of more than max_tiles tiles.
+    '''
     zoom = [16, 13]
-    gpx = gpxpy.parse(data_file)
-
-    lat = [90, -90]
-    lon = [180, -180]
-
-    output = {"wps": [], "urls": []}
-
-    for track in gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                if(point.latitude < lat[0]):
-                    lat[0] = point.latitude
-                if(point.latitude > lat[1]):
-                    lat[1] = point.latitude
-                if(point.longitude < lon[0]):
-                    lon[0] = point.longitude
-                if(point.longitude > lon[1]):
-                    lon[1] = point.longitude
-                output['wps'].append(
-                    {"lon": point.longitude, "lat": point.latitude})
-
+    track = gpx_reader.read(data_file)
+    if len(track) == 0:
+        # no track or route, use the waypoints
+        track = gpx_reader.Track(track.wpt_lon, track.wpt_lat, track.wpt_lon, track.wpt_lat)
+    if len(track) == 0:
+        raise ValueError("no points in GPX file")
+    buffer = {**corridor_buffer, **(buffer or {})}
+
+    lon, lat = track.bounds()
+    keep = trackfile.simplify(track.lon, track.lat, track_tolerance if tolerance is None else tolerance)
+    output = {"wps": {"lon": track.lon[keep].tolist(), "lat": track.lat[keep].tolist()}, "urls": []}
+    output['points'] = len(track)
+    output['points_kept'] = len(keep)
+
+    bbox_tiles = 0
     for z in zoom:
-        output['urls'] += get_jobs_for(lon, lat, z)
+        bbox_tiles += count_jobs_for(lon, lat, z)
+        # counted before the jobs are listed and ordered
+        if mode == "corridor":
+            count = count_corridor_min(lon, lat, z, buffer[z])
+            if len(output['urls']) + count <= max_tiles:
+                tiles = corridor_tiles(track.lon, track.lat, z, buffer[z])
+                count = len(tiles)
+        else:
+            count = count_jobs_for(lon, lat, z)
+        if len(output['urls']) + count > max_tiles:
+            raise TooManyTiles("the track needs more than {} tiles".format(max_tiles))
+        if mode == "corridor":
+            output['urls'] += [tile_job(z, int(x), int(y)) for x, y in tiles]
+        else:
+            output['urls'] += get_jobs_for(lon, lat, z)
+    output['urls'] = order_jobs(output['urls'], track.lon, track.lat)
+    mx, my = trackfile.to_meters(track.lon, track.lat)
+    output['km'] = round(float(numpy.hypot(numpy.diff(mx), numpy.diff(my)).sum()) / 1000, 3)
+    output['mode'] = mode
+    output['tiles_saved'] = bbox_tiles - len(output['urls'])
 
     return output
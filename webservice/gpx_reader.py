@@ -0,0 +1,82 @@
+"""Streaming GPX reader for large tracks.
+
+The file is parsed with iterparse and every point goes straight into a
+float array, elements are dropped as soon as they are read. Track and
+route points form the line, waypoints are kept separately.
+"""
+import math
+from array import array
+import xml.etree.ElementTree as ET
+import numpy
+
+LINE_POINTS = {"trkpt", "rtept"}
+# elements whose children are not needed anymore once they are closed
+CONTAINERS = {"trkseg", "trk", "rte"}
+
+
+class Track:
+    '''Longitudes and latitudes of a GPX file as numpy arrays'''
+
+    def __init__(self, lon, lat, wpt_lon, wpt_lat):
+        self.lon = lon
+        self.lat = lat
+        self.wpt_lon = wpt_lon
+        self.wpt_lat = wpt_lat
+
+    def __len__(self):
+        return len(self.lon)
+
+    def bounds(self):
+        '''Return ([lon min, lon max], [lat min, lat max]) of the line'''
+        return ([float(self.lon.min()), float(self.lon.max())],
+                [float(self.lat.min()), float(self.lat.max())])
+
+
+def coordinate(elem, name):
+    '''lat or lon attribute of a point, ValueError if it is missing or not a finite number'''
+    value = elem.get(name)
+    if value is None:
+        raise ValueError("{} without {}".format(elem.tag.rsplit("}", 1)[-1], name))
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("{} {} is not finite".format(name, value))
+    return value
+
+
+def read(source):
+    '''Read a GPX file (file name or file object) into a Track'''
+    arrays = {"line": (array("d"), array("d")), "wpt": (array("d"), array("d"))}
+    for _, elem in ET.iterparse(source, events=("end",)):
+        tag = elem.tag.rsplit("}", 1)[-1]
+        if tag in LINE_POINTS or tag == "wpt":
+            lon, lat = arrays["line" if tag in LINE_POINTS else "wpt"]
+            lon.append(coordinate(elem, "lon"))
+            lat.append(coordinate(elem, "lat"))
+            elem.clear()
+        elif tag in CONTAINERS:
+            elem.clear()
+
+    def to_numpy(a):
+        return numpy.frombuffer(a, dtype=numpy.float64) if len(a) else numpy.zeros(0)
+
+    line, wpt = arrays["line"], arrays["wpt"]
+    return Track(to_numpy(line[0]), to_numpy(line[1]), to_numpy(wpt[0]), to_numpy(wpt[1]))
+
+
+def lon2tilef(lon, zoom):
+    return (numpy.asarray(lon) + 180) / 360 * 2.0 ** zoom
+
+
+# Web Mercator ends here, tiles of higher latitudes do not exist
+max_latitude = 85.0511287798
+
+
+def lat2tilef(lat, zoom):
+    lat = numpy.radians(numpy.clip(numpy.asarray(lat), -max_latitude, max_latitude))
+    return (1 - numpy.log(numpy.tan(lat) + 1 / numpy.cos(lat)) / numpy.pi) / 2 * 2.0 ** zoom
+
+
+def tile_indices(lon, lat, zoom):
+    '''Tile x and y of every point'''
+    return (numpy.floor(lon2tilef(lon, zoom)).astype(numpy.int64),
+            numpy.floor(lat2tilef(lat, zoom)).astype(numpy.int64))
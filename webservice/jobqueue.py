@@ -0,0 +1,118 @@
+"""Durable job queue on redis lists.
+
+Job ids wait in Queue:<name>. A worker moves an id atomically to
+Queue:<name>:processing (BLMOVE) and holds a lease, a deadline in the
+Queue:<name>:leases hash that it extends while the job runs. Finished
+jobs are acked, failed jobs go back to the queue until they used up
+their attempts and end in Queue:<name>:failed. Jobs whose lease ran out
+(the worker died or hangs) are put back by requeue_expired.
+"""
+import time
+import database
+
+
+class JobQueue:
+    '''Redis backed queue of job ids with leases and retries'''
+
+    def __init__(self, name="jobs", visibility=300, retries=3):
+        self.key = "Queue:" + name
+        self.processing = self.key + ":processing"
+        self.leases = self.key + ":leases"
+        self.attempts = self.key + ":attempts"
+        self.failed = self.key + ":failed"
+        # seconds a job may run without extending its lease
+        self.visibility = visibility
+        # attempts before a job is given up
+        self.retries = retries
+
+    @property
+    def redis(self):
+        return database.client
+
+    def enqueue(self, id):
+        '''Add a job, a job that is already waiting is not added twice'''
+        with self.redis.pipeline() as pipe:
+            pipe.lrem(self.key, 0, id)
+            pipe.hdel(self.attempts, id)
+            pipe.lpush(self.key, id)
+            pipe.execute()
+
+    def reserve(self, timeout=5):
+        '''Wait up to timeout seconds for a job, returns its id or None'''
+        id = self.redis.blmove(self.key, self.processing, timeout, "RIGHT", "LEFT")
+        if id is None:
+            return None
+        with self.redis.pipeline() as pipe:
+            pipe.hset(self.leases, id, time.time() + self.visibility)
+            pipe.hincrby(self.attempts, id, 1)
+            pipe.execute()
+        return id
+
+    def extend(self, id):
+        '''Renew the lease of a running job'''
+        self.redis.hset(self.leases, id, time.time() + self.visibility)
+
+    def ack(self, id):
+        '''Remove a finished job'''
+        with self.redis.pipeline() as pipe:
+            pipe.lrem(self.processing, 1, id)
+            pipe.hdel(self.leases, id)
+            pipe.hdel(self.attempts, id)
+            pipe.execute()
+
+    def fail(self, id):
+        '''
+        Put a failed job back into the queue, returns False once it used up
+        its attempts and was moved to the failed list instead.
+        '''
+        if not self.redis.lrem(self.processing, 1, id):
+            # requeued meanwhile, its lease expired
+            return True
+        return self.release(id)
+
+    def release(self, id):
+        '''Queue a job taken from processing again or give it up, see fail'''
+        attempts = int(self.redis.hget(self.attempts, id) or 0)
+        retry = attempts < self.retries
+        with self.redis.pipeline() as pipe:
+            pipe.hdel(self.leases, id)
+            if retry:
+                pipe.rpush(self.key, id)
+            else:
+                pipe.hdel(self.attempts, id)
+                pipe.lpush(self.failed, id)
+            pipe.execute()
+        return retry
+
+    def requeue_expired(self):
+        '''
+        Put jobs with an expired lease back into the queue, an expiry counts
+        as a failed attempt. Returns {id: False if it was given up}.
+        '''
+        now = time.time()
+        expired = {}
+        for id in self.redis.lrange(self.processing, 0, -1):
+            deadline = self.redis.hget(self.leases, id)
+            if deadline is None:
+                # reserved a moment ago, the lease is not written yet
+                self.redis.hsetnx(self.leases, id, now + self.visibility)
+                continue
+            if float(deadline) > now:
+                continue
+            # only the one that removes it may requeue it
+            if self.redis.lrem(self.processing, 1, id):
+                expired[id] = self.release(id)
+        return expired
+
+    def ids(self):
+        '''Ids of all queued and running jobs'''
+        with self.redis.pipeline() as pipe:
+            pipe.lrange(self.key, 0, -1)
+            pipe.lrange(self.processing, 0, -1)
+            queued, running = pipe.execute()
+        return set(queued) | set(running)
+
+    def stats(self):
+        return {"queued": self.redis.llen(self.key),
+                "processing": self.redis.llen(self.processing),
+                "failed": self.redis.llen(self.failed)}
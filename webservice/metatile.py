@@ -0,0 +1,35 @@
+"""Metatiles: N x N tiles converted as one image.
+
+Filtering and dithering a block of tiles at once avoids the seams the
+edge filter leaves at every tile border and pays the per image setup
+once per block, as gen_splash.py does for the splash screen. Tiles of a
+block without a source stay white.
+"""
+from io import BytesIO
+from PIL import Image
+
+TILE = 256
+
+
+def origin(x, y, n):
+    '''Top left tile of the block containing x, y'''
+    return x // n * n, y // n * n
+
+
+def positions(x, y, n):
+    '''All tiles (x, y) of the block containing x, y'''
+    bx, by = origin(x, y, n)
+    return [(bx + dx, by + dy) for dy in range(n) for dx in range(n)]
+
+
+def stitch(sources, n):
+    '''One RGB image of n x n tiles, sources maps (dx, dy) to png data'''
+    mosaic = Image.new("RGB", (TILE * n, TILE * n), (255, 255, 255))
+    for (dx, dy), src in sources.items():
+        mosaic.paste(Image.open(BytesIO(src)).convert("RGB"), (dx * TILE, dy * TILE))
+    return mosaic
+
+
+def split(image, cells):
+    '''Cut the tiles at (dx, dy) of cells out of a block image'''
+    return [image.crop((dx * TILE, dy * TILE, (dx + 1) * TILE, (dy + 1) * TILE)) for dx, dy in cells]
@@ -0,0 +1,59 @@
+"""Overview tiles composed from cached source tiles of a higher zoom level.
+
+A tile of zoom z covers 2^(zoom-z) x 2^(zoom-z) tiles of zoom. When all of
+them have a cached source png, the overview source is the mosaic of those
+scaled down to 256x256 (before dithering, like a downloaded source).
+Composed sources are stored as "src.png" with {"composed": zoom} in
+"src.meta", so the next lower level can be composed from them.
+"""
+import json
+from io import BytesIO
+from PIL import Image
+
+# highest zoom level whose sources are used
+source_zoom = 16
+# do not compose from more than this many levels further down (8x8 tiles)
+max_levels = 3
+
+
+def compose(store, z, x, y, zoom):
+    '''Source png of z/x/y scaled down from the cached sources of zoom, None if one is missing'''
+    n = 2 ** (zoom - z)
+    sources = []
+    for dx in range(n):
+        for dy in range(n):
+            src = store.get(zoom, x * n + dx, y * n + dy, "src.png")
+            if src is None:
+                return None
+            sources.append((dx, dy, src))
+    mosaic = Image.new("RGB", (256 * n, 256 * n))
+    for dx, dy, src in sources:
+        mosaic.paste(Image.open(BytesIO(src)).convert("RGB"), (dx * 256, dy * 256))
+    img = BytesIO()
+    mosaic.resize((256, 256), Image.LANCZOS).save(img, format="png")
+    return img.getvalue()
+
+
+def compose_source(store, z, x, y):
+    '''
+    Compose and store the source png of z/x/y from the closest zoom level
+    that is completely cached, returns it or None.
+    '''
+    z, x, y = int(z), int(x), int(y)
+    for zoom in range(z + 1, min(source_zoom, z + max_levels) + 1):
+        src = compose(store, z, x, y, zoom)
+        if src is not None:
+            store.put(z, x, y, "src.png", src)
+            store.put(z, x, y, "src.meta", json.dumps({"composed": zoom}).encode())
+            return src
+    return None
+
+
+def parents(tiles, zoom):
+    '''The tiles of zoom covering any of the (z, x, y) tiles'''
+    found = set()
+    for z, x, y in tiles:
+        if z > zoom:
+            n = 2 ** (z - zoom)
+            found.add((zoom, x // n, y // n))
+    return sorted(found)
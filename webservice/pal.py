@@ -1,4 +1,8 @@
 from math import sqrt, pow
+import hashlib
+import os
+import numpy
+from PIL import Image
 
 BLACK = (0,0,0)
 WHITE = (255, 255, 255)
@@ -113,3 +117,100 @@ def map_color(pxl, x, y):
             else:
                 new_pxl = (color[0], color[1], color[2])
     return new_pxl
+
+
+def _palette_rgb():
+    return numpy.array([color[:3] for color in palette], dtype=numpy.int32)
+
+
+def _pattern_table():
+    # output color of every palette entry for each (y % 4, x % 4) phase
+    table = numpy.zeros((len(palette), 4, 4, 3), dtype=numpy.uint8)
+    for i, color in enumerate(palette):
+        for y in range(4):
+            for x in range(4):
+                if len(color) > 3:
+                    table[i, y, x] = color[3](x, y, color[4])
+                else:
+                    table[i, y, x] = color[:3]
+    return table
+
+
+palette_rgb = _palette_rgb()
+pattern_table = _pattern_table()
+
+
+# RGB -> palette index table, one byte for every 24 bit color
+LUT_VERSION = 1
+lut_dir = os.environ.get("PAL_LUT_DIR", os.path.dirname(os.path.abspath(__file__)))
+_lut = None
+
+
+def palette_hash():
+    h = hashlib.sha1("lut{}".format(LUT_VERSION).encode())
+    h.update(palette_rgb.tobytes())
+    # the dither patterns change the output without changing the table
+    h.update(pattern_table.tobytes())
+    return h.hexdigest()
+
+
+def lut_file():
+    return os.path.join(lut_dir, "pal_lut_{}.bin".format(palette_hash()[:16]))
+
+
+def build_lut():
+    lut = numpy.empty((256, 256, 256), dtype=numpy.uint8)
+    channel = numpy.arange(256, dtype=numpy.int32)
+    # squared distance per channel, summed by broadcasting over r, g, b
+    square = [(channel[:, None] - palette_rgb[:, c]) ** 2 for c in range(3)]
+    for r in range(0, 256, 32):
+        best = numpy.full((32, 256, 256), numpy.iinfo(numpy.int32).max, dtype=numpy.int32)
+        index = lut[r:r + 32]
+        for i in range(len(palette_rgb)):
+            delta = (square[0][r:r + 32, i, None, None] +
+                     square[1][None, :, i, None] + square[2][None, None, :, i])
+            closer = delta < best
+            best[closer] = delta[closer]
+            index[closer] = i
+    return lut.reshape(-1)
+
+
+def get_lut():
+    """Load the lookup table for the current palette, build it if needed.
+
+    The table is memory mapped, so all processes share the same pages.
+    A changed palette gets a new file name and the table is rebuilt.
+    """
+    global _lut
+    if _lut is not None:
+        return _lut
+    filename = lut_file()
+    if not os.path.isfile(filename) or os.path.getsize(filename) != 1 << 24:
+        lut = build_lut()
+        tmp = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            lut.tofile(tmp)
+            os.replace(tmp, filename)
+        except OSError:
+            # read only install, keep the table in memory
+            _lut = lut
+            return _lut
+    _lut = numpy.memmap(filename, dtype=numpy.uint8, mode="r")
+    return _lut
+
+
+def map_colors(pixels):
+    """Vectorized map_color for a whole (height, width, 3) RGB array."""
+    pixels = numpy.asarray(pixels, dtype=numpy.uint32)
+    rgb = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+    index = get_lut()[rgb]
+    height, width = index.shape
+    y = (numpy.arange(height) % 4)[:, None]
+    x = (numpy.arange(width) % 4)[None, :]
+    return pattern_table[index, y, x]
+
+
+def dither(image):
+    """Map a PIL image onto the e-ink palette, returns a RGB image."""
+    pixels = numpy.asarray(image.convert("RGB"))
+    return Image.fromarray(map_colors(pixels), "RGB")
@@ -0,0 +1,182 @@
+"""Fill the tile cache of the web service for a region.
+
+    python seed.py --zoom 16,13 --bbox 11.0,47.5,12.0,48.0
+    python seed.py --zoom 16,15,14,13 --geojson bavaria.geojson
+    python seed.py --zoom 16,13 --gpx track.gpx [--buffer 16:4,13:2]
+    python seed.py --zoom 15,14,13 --overviews [--offline]
+
+Tiles are converted by tilecache.load_tile in one process per core and
+land in TILE_STORE exactly as a request to /tile would store them.
+Tiles already in the cache are skipped, --refresh revalidates them with
+the tile server instead.
+--overviews builds the given levels above all cached z16 sources, composed
+from the cache where it is complete (and only there with --offline).
+"""
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy
+import gpx_converter
+import gpx_reader
+import overview
+import tilecache
+
+
+def bbox_tiles(bbox, zoom):
+    '''All tiles of bbox (min lon, min lat, max lon, max lat)'''
+    lon0, lat0, lon1, lat1 = bbox
+    x0, x1 = sorted((gpx_converter.lon2tile(lon0, zoom), gpx_converter.lon2tile(lon1, zoom)))
+    y0, y1 = sorted((gpx_converter.lat2tile(lat0, zoom), gpx_converter.lat2tile(lat1, zoom)))
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield zoom, x, y
+
+
+def polygon_rings(geojson):
+    '''Outer rings and holes of all (multi)polygons of a GeoJSON document, as one list'''
+    if geojson["type"] == "FeatureCollection":
+        return [ring for feature in geojson["features"] for ring in polygon_rings(feature)]
+    if geojson["type"] == "Feature":
+        return polygon_rings(geojson["geometry"])
+    if geojson["type"] == "Polygon":
+        return geojson["coordinates"]
+    if geojson["type"] == "MultiPolygon":
+        return [ring for polygon in geojson["coordinates"] for ring in polygon]
+    raise ValueError("no polygon in GeoJSON " + geojson["type"])
+
+
+def polygon_tiles(rings, zoom):
+    '''
+    Tiles with their center inside the polygon (even-odd rule, so holes
+    are left out) and all tiles the rings pass through.
+    '''
+    tiles = set()
+    edges = []
+    for ring in rings:
+        ring = numpy.asarray(ring, dtype=numpy.float64)
+        for job in gpx_converter.get_corridor_jobs_for(ring[:, 0], ring[:, 1], zoom, 0):
+            tiles.add((job['z'], job['x'], job['y']))
+        fx = gpx_reader.lon2tilef(ring[:, 0], zoom)
+        fy = gpx_reader.lat2tilef(ring[:, 1], zoom)
+        edges.append(numpy.stack([fx, fy, numpy.roll(fx, -1), numpy.roll(fy, -1)], axis=1))
+    x0, y0, x1, y1 = numpy.concatenate(edges).T
+    for row in range(int(min(y0.min(), y1.min())), int(max(y0.max(), y1.max())) + 1):
+        # crossings of the edges with the line through the tile centers of the row
+        cy = row + 0.5
+        crossing = (y0 <= cy) != (y1 <= cy)
+        t = (cy - y0[crossing]) / (y1[crossing] - y0[crossing])
+        xs = numpy.sort(x0[crossing] + t * (x1[crossing] - x0[crossing]))
+        for start, end in zip(xs[0::2], xs[1::2]):
+            for x in range(int(numpy.ceil(start - 0.5)), int(numpy.floor(end - 0.5)) + 1):
+                tiles.add((zoom, x, row))
+    return sorted(tiles)
+
+
+def corridor_tiles(track, zoom, buffer):
+    for job in gpx_converter.get_corridor_jobs_for(track.lon, track.lat, zoom, buffer):
+        yield job['z'], job['x'], job['y']
+
+
+def overview_tiles(zoom):
+    '''Tiles of zoom above the cached sources of the overview source zoom'''
+    sources = (key[:3] for key in tilecache.tile_store().keys()
+               if key[0] == overview.source_zoom and key[3] == "src.png")
+    return overview.parents(sources, zoom)
+
+
+def cached(z, x, y):
+    return (z, x, y, tilecache.raw_kind()) in tilecache.tile_store()
+
+
+def seed_tile(tile):
+    z, x, y = tile
+    try:
+        if refresh and cached(z, x, y):
+            tilecache.refresh_tile(z, x, y)
+            return True
+        return tilecache.load_tile(z, x, y, 'raw') is not None
+    except Exception as e:
+        print("failed", z, x, y, e)
+        return False
+
+
+refresh = False
+
+
+def seed(regions, processes=None, progress_every=5):
+    '''
+    Convert all tiles the regions (callables returning tile iterators)
+    list, returns (converted, failed)
+    '''
+    def missing():
+        for region in regions:
+            for tile in region():
+                if refresh or not cached(*tile):
+                    yield tile
+
+    total = sum(1 for _ in missing())
+    print(total, "tiles to convert")
+    ok = failed = 0
+    start = last = time.time()
+    with Pool(processes=processes or os.cpu_count()) as pool:
+        for result in pool.imap_unordered(seed_tile, missing(), chunksize=8):
+            if result:
+                ok += 1
+            else:
+                failed += 1
+            now = time.time()
+            if now - last >= progress_every or ok + failed == total:
+                last = now
+                rate = (ok + failed) / max(now - start, 1e-9)
+                print("{}/{} tiles, {} failed, {:.1f} tiles/s, ETA {:.0f} s".format(
+                    ok + failed, total, failed, rate, (total - ok - failed) / rate))
+    return ok, failed
+
+
+def main():
+    global refresh
+    parser = argparse.ArgumentParser(description="Convert the tiles of a region into the tile cache")
+    parser.add_argument("--zoom", default="16,13", help="zoom levels, e.g. 16,13")
+    parser.add_argument("--bbox", help="min lon,min lat,max lon,max lat")
+    parser.add_argument("--geojson", help="GeoJSON file with (multi)polygons")
+    parser.add_argument("--gpx", help="GPX file, tiles along the track")
+    parser.add_argument("--buffer", default="", help="corridor width for --gpx in tiles per zoom, e.g. 16:4,13:2")
+    parser.add_argument("--processes", type=int, help="parallel conversions, one per core by default")
+    parser.add_argument("--refresh", action="store_true", help="revalidate cached tiles with the tile server")
+    parser.add_argument("--overviews", action="store_true", help="all tiles above the cached z16 sources")
+    parser.add_argument("--offline", action="store_true", help="do not download, only compose overviews")
+    args = parser.parse_args()
+    refresh = args.refresh
+    tilecache.offline = args.offline
+
+    zooms = [int(z) for z in args.zoom.split(",")]
+    regions = []
+    if args.bbox:
+        bbox = [float(v) for v in args.bbox.split(",")]
+        regions += [lambda z=z: bbox_tiles(bbox, z) for z in zooms]
+    if args.geojson:
+        with open(args.geojson) as f:
+            rings = polygon_rings(json.load(f))
+        regions += [lambda z=z: polygon_tiles(rings, z) for z in zooms]
+    if args.gpx:
+        track = gpx_reader.read(args.gpx)
+        buffer = {**gpx_converter.corridor_buffer,
+                  **{int(z): int(b) for z, b in (item.split(":") for item in args.buffer.split(",") if item)}}
+        if any(not 0 <= b <= gpx_converter.max_buffer for b in buffer.values()):
+            parser.error("--buffer must be 0 to {} tiles".format(gpx_converter.max_buffer))
+        regions += [lambda z=z: corridor_tiles(track, z, buffer.get(z, 0)) for z in zooms]
+    if args.overviews:
+        regions += [lambda z=z: overview_tiles(z) for z in zooms]
+    if not regions:
+        parser.error("one of --bbox, --geojson, --gpx or --overviews is needed")
+
+    print("Seeding", tilecache.store_location, "zoom", zooms)
+    ok, failed = seed(regions, args.processes)
+    print(ok, "tiles converted,", failed, "failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Cached tile conversion shared by the web service and the job builder.
+
+load_tile(z, x, y, ext) returns the png or raw payload of a tile. Tiles
+are downloaded, dithered and encoded once and then kept in the tile store
+(TILE_STORE: a directory or a *.pack file). The source png and its
+ETag/Last-Modified are kept as well, refresh_tile revalidates them.
+Sources of lower zoom levels are composed from cached higher zoom
+sources when possible (overview.py) instead of being downloaded.
+With METATILE=n the n x n block around a missing tile is converted as
+one image (metatile.py).
+"""
+import json
+import requests
+from PIL import Image, ImageFilter
+from io import BytesIO
+import lz4.frame
+from os import getpid, environ
+from concurrent.futures import ThreadPoolExecutor
+import pal
+import epd5in65f
+import fetcher
+import metatile
+import overview
+import tilestore
+
+tile_url = environ.get('TILE_URL', "https://platinenmacher.tech/navi/tiles/{z}/{x}/{y}.png")
+# tile cache: a directory or a single *.pack file
+store_location = environ.get('TILE_STORE', 'tiles')
+# store cached .raw tiles lz4 framed (smaller, but needs a decompress per request)
+raw_lz4 = False
+# compose missing overview sources from cached tiles of higher zoom levels
+compose_overviews = environ.get('COMPOSE_OVERVIEWS', '1') == '1'
+# never download, only convert what can be composed from the cache
+offline = False
+# convert blocks of METATILE x METATILE tiles as one image (1: every tile alone)
+metatile_size = int(environ.get('METATILE', 1))
+
+epd = epd5in65f.EPD()
+# 256x256 pixels, two per byte
+RAW_TILE_BYTES = 256 * 256 // 2
+# dithered tiles depend on the palette, raw tiles on the encoder too,
+# a change gets new cache files
+dither_tag = pal.palette_hash()[:8]
+raw_cache_tag = "{}{}".format(dither_tag, epd5in65f.ENCODER_VERSION)
+
+_store = None
+
+
+def tile_store():
+    # one store per process, flock does not separate forked uWSGI workers
+    global _store
+    if _store is None or _store[0] != getpid():
+        _store = (getpid(), tilestore.open_store(store_location))
+    return _store[1]
+
+
+def raw_kind():
+    return "{}.{}".format(raw_cache_tag, "lz4" if raw_lz4 else "raw")
+
+
+def png_kind():
+    return "{}.png".format(dither_tag)
+
+
+def cached_tile(store, z, x, y, ext):
+    if ext == 'raw':
+        data = store.get(z, x, y, raw_kind())
+        if data is not None and raw_lz4:
+            try:
+                data = lz4.frame.decompress(data)
+            except RuntimeError:
+                data = None
+        if data is not None and len(data) != RAW_TILE_BYTES:
+            # damaged, convert again
+            print("bad tile", z, x, y, len(data))
+            return None
+        return data
+    return store.get(z, x, y, png_kind())
+
+
+def load_tile(z, x, y, ext):
+    '''Return the png or raw payload of a tile, None if the download failed'''
+    store = tile_store()
+    data = cached_tile(store, z, x, y, ext)
+    if data is not None:
+        print("cache hit", z, x, y, ext)
+        return data
+
+    # concurrent misses for the same tile (block) wait here for one conversion
+    with store.locks(*lock_key(z, x, y)):
+        data = cached_tile(store, z, x, y, ext)
+        if data is not None:
+            print("converted by concurrent request", z, x, y, ext)
+            return data
+        return convert(store, z, x, y, ext)
+
+
+def lock_key(z, x, y):
+    if metatile_size > 1:
+        return (z,) + metatile.origin(int(x), int(y), metatile_size)
+    return z, x, y
+
+
+def convert(store, z, x, y, ext):
+    png = store.get(z, x, y, png_kind())
+    if png is not None:
+        out = Image.open(BytesIO(png))
+    elif metatile_size > 1:
+        return convert_block(store, z, x, y, ext)
+    else:
+        src = load_source(store, z, x, y)
+        if src is None:
+            return None
+        out, png = dither_source(store, z, x, y, src)
+
+    if ext == 'png':
+        return png
+    return store_raw(store, z, x, y, out)
+
+
+def convert_block(store, z, x, y, ext):
+    '''
+    Convert the metatile block around z/x/y as one image and store all its
+    tiles, returns the png or raw payload of z/x/y.
+    '''
+    x, y = int(x), int(y)
+    n = metatile_size
+    cells = metatile.positions(x, y, n)
+    with ThreadPoolExecutor(max_workers=len(cells)) as pool:
+        sources = list(pool.map(lambda cell: load_source(store, z, *cell), cells))
+    if sources[cells.index((x, y))] is None:
+        return None
+    bx, by = metatile.origin(x, y, n)
+    present = {(cx - bx, cy - by): src for (cx, cy), src in zip(cells, sources) if src is not None}
+    out = pal.dither(metatile.stitch(present, n).filter(ImageFilter.EDGE_ENHANCE))
+    result = None
+    for (dx, dy), tile in zip(present, metatile.split(out, list(present))):
+        img = BytesIO()
+        tile.save(img, format='png')
+        store.put(z, bx + dx, by + dy, png_kind(), img.getvalue())
+        data = store_raw(store, z, bx + dx, by + dy, tile)
+        if (bx + dx, by + dy) == (x, y):
+            result = img.getvalue() if ext == 'png' else data
+    return result
+
+
+def load_source(store, z, x, y):
+    '''Source png of a tile: cached, composed from higher zoom levels or downloaded'''
+    src = store.get(z, x, y, "src.png")
+    if src is None and compose_overviews:
+        src = overview.compose_source(store, z, x, y)
+    if src is None:
+        print("cache miss")
+        src = fetch_source(store, z, x, y)
+    return src
+
+
+def fetch_source(store, z, x, y, validators=None):
+    '''
+    Download the source png of a tile and store it with its validators.
+    Returns the png, None if the download failed or (with validators)
+    the stored copy is current.
+    '''
+    if offline:
+        return None
+    url = tile_url.format(z=z, x=x, y=y)
+    print("GET:", url)
+    try:
+        fetched = fetcher.get(url, validators)
+    except requests.RequestException as e:
+        print("GET failed:", url, e)
+        return None
+    if fetched.status != 200:
+        return None
+    store.put(z, x, y, "src.png", fetched.content)
+    store.put(z, x, y, "src.meta", json.dumps(fetched.validators).encode())
+    return fetched.content
+
+
+def dither_source(store, z, x, y, src):
+    '''Dither a source png and store the result, returns the image and its png'''
+    t = Image.open(BytesIO(src))
+    out = pal.dither(t.convert("RGB").filter(ImageFilter.EDGE_ENHANCE))
+    img = BytesIO()
+    out.save(img, format='png')
+    png = img.getvalue()
+    store.put(z, x, y, png_kind(), png)
+    return out, png
+
+
+def store_raw(store, z, x, y, out):
+    data = epd.getbuffer_packed(out)
+    if raw_lz4:
+        store.put(z, x, y, raw_kind(), lz4.frame.compress(data))
+    else:
+        store.put(z, x, y, raw_kind(), data)
+    return data
+
+
+def refresh_tile(z, x, y):
+    '''
+    Revalidate the source of a cached tile with the tile server and convert
+    the tile again if it changed. Returns True if it was converted.
+    '''
+    store = tile_store()
+    with store.locks(z, x, y):
+        meta = store.get(z, x, y, "src.meta")
+        validators = json.loads(bytes(meta)) if meta is not None else None
+        src = fetch_source(store, z, x, y, validators)
+        if src is None:
+            return False
+        out, _ = dither_source(store, z, x, y, src)
+        store_raw(store, z, x, y, out)
+        return True
@@ -0,0 +1,367 @@
+"""Tile stores keyed by (z, x, y, kind).
+
+TileDir keeps the flat tiles/{z}_{x}_{y}.{kind} layout of the web service.
+TilePack appends all tiles to one pack file and reads them through mmap.
+
+Pack format: an 8 byte file header followed by records
+    magic(4) z(B) x(I) y(I) kind length(B) data length(I) crc32(I) kind data
+Later records for the same key replace earlier ones. Writers append under
+an exclusive flock, readers need no lock and pick up new records lazily.
+Damaged records are skipped, only a partial record at the end of the pack
+is cut off. <pack>.idx keeps the record offsets, so opening a pack only
+checks the records written since it was saved. Compaction drops replaced
+records, other processes follow it at their next write or lookup miss.
+Both stores have `locks(z, x, y)` to make sure only one process converts
+a missing tile.
+
+    python tilestore.py import <pack> <tile dir> [<tile dir> ...]
+imports existing directory caches into a pack.
+
+    python tilestore.py compact <pack>
+rewrites a pack without its replaced records.
+"""
+import fcntl
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+from contextlib import contextmanager
+
+PACK_HEADER = b"INPK\x01\x00\x00\x00"
+RECORD_MAGIC = b"TILE"
+RECORD = struct.Struct("<4sBIIBII")
+# <pack>.idx: header, pack inode and offset it covers, then per tile
+#     z(B) x(I) y(I) kind length(B) data offset(Q) data length(I) kind
+INDEX_HEADER = b"INIX\x01\x00\x00\x00"
+INDEX_HEAD = struct.Struct("<QQ")
+INDEX_ENTRY = struct.Struct("<BIIBQI")
+# write the index file again after this many new bytes were indexed
+index_interval = 64 * 1024 * 1024
+
+
+class TileLocks:
+    '''
+    Striped locks that serialize work on the same tile between threads
+    and between processes (flock on one of `stripes` lock files).
+    '''
+
+    def __init__(self, folder, stripes=256):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.stripes = stripes
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def __call__(self, z, x, y):
+        n = (int(z) * 7919 + int(x) * 104729 + int(y)) % self.stripes
+        with self.locks[n]:
+            fd = os.open(os.path.join(self.folder, "{}.lock".format(n)), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+
+class TileDir:
+    '''Tiles as single files in one directory'''
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.locks = TileLocks(os.path.join(root, ".locks"))
+
+    def filename(self, z, x, y, kind):
+        return os.path.join(self.root, "{z}_{x}_{y}.{kind}".format(z=z, x=x, y=y, kind=kind))
+
+    def get(self, z, x, y, kind):
+        '''Return the tile data or None'''
+        try:
+            with open(self.filename(z, x, y, kind), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, z, x, y, kind, data):
+        '''Store a tile, readers never see a partial file'''
+        filename = self.filename(z, x, y, kind)
+        tmp = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+    def __contains__(self, key):
+        return os.path.exists(self.filename(*key))
+
+    def keys(self):
+        for name in os.listdir(self.root):
+            m = flat_tile.match(name)
+            if m and not m.group(4).endswith(".tmp"):
+                z, x, y, kind = m.groups()
+                yield int(z), int(x), int(y), kind
+
+
+class TilePack:
+    '''Tiles appended to a single file, indexed in memory'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        # flock does not separate threads sharing self.fd
+        self.mutex = threading.RLock()
+        self.locks = TileLocks(filename + ".locks")
+        self._open()
+
+    def _open(self):
+        # (index, map) for lookups without the mutex, None while (re)opening
+        self.view = None
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index = {}
+        self.end = len(PACK_HEADER)
+        self.map = None
+        with self.mutex:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            if os.fstat(self.fd).st_size == 0:
+                os.write(self.fd, PACK_HEADER)
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        if os.pread(self.fd, len(PACK_HEADER), 0) != PACK_HEADER:
+            raise ValueError("{} is not a tile pack".format(self.filename))
+        self.load_index()
+        # pack offset up to which the index file is current
+        self.saved = self.end
+        self.refresh()
+
+    def _reopen(self):
+        os.close(self.fd)
+        self._open()
+
+    def replaced(self):
+        '''True if the pack file was replaced (compacted) since it was opened'''
+        try:
+            return os.stat(self.filename).st_ino != os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def close(self):
+        self.save_index()
+        self.view = None
+        self.map = None
+        os.close(self.fd)
+
+    @contextmanager
+    def lock(self):
+        '''Exclusive write lock on the pack, follows a compaction of another process'''
+        with self.mutex:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            while self.replaced():
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                self._reopen()
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def refresh(self, truncate=False):
+        '''Index records appended since the last refresh.
+        truncate: cut off a partial record at the end (only with the lock held)
+        '''
+        with self.mutex:
+            if self.replaced():
+                self._reopen()
+            else:
+                self._refresh(truncate)
+
+    def _refresh(self, truncate):
+        size = os.fstat(self.fd).st_size
+        if size <= self.end and self.map is not None:
+            return
+        self.map = mmap.mmap(self.fd, size, prot=mmap.PROT_READ)
+        self.view = (self.index, self.map)
+        pos = good = self.end
+        while pos + RECORD.size <= size:
+            magic, z, x, y, kind_len, length, crc = RECORD.unpack_from(self.map, pos)
+            start = pos + RECORD.size + kind_len
+            if magic == RECORD_MAGIC and start + length <= size and \
+                    zlib.crc32(self.map[start:start + length]) == crc:
+                kind = self.map[pos + RECORD.size:start].decode()
+                self.index[(z, x, y, kind)] = (start, length)
+                pos = good = start + length
+                continue
+            # damaged or still being written, go on at the next record
+            pos = self.map.find(RECORD_MAGIC, pos + 1)
+            if pos < 0:
+                break
+        self.end = good
+        if truncate and self.partial(good, size):
+            # left over from a writer that died mid record
+            os.truncate(self.fd, good)
+        if self.end - self.saved > index_interval:
+            self.save_index()
+
+    def partial(self, pos, size):
+        '''True if the data from pos to the end of the pack is the start of a record'''
+        if pos >= size:
+            return False
+        if size - pos < RECORD.size:
+            head = self.map[pos:size]
+            return RECORD_MAGIC.startswith(head[:len(RECORD_MAGIC)])
+        magic, z, x, y, kind_len, length, crc = RECORD.unpack_from(self.map, pos)
+        return magic == RECORD_MAGIC and pos + RECORD.size + kind_len + length > size
+
+    def index_file(self):
+        return self.filename + ".idx"
+
+    def load_index(self):
+        '''Take the offsets of the index file if it belongs to this pack'''
+        try:
+            with open(self.index_file(), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if not data.startswith(INDEX_HEADER):
+            return
+        ino, end = INDEX_HEAD.unpack_from(data, len(INDEX_HEADER))
+        if ino != os.fstat(self.fd).st_ino or end > os.fstat(self.fd).st_size:
+            return
+        index = {}
+        pos = len(INDEX_HEADER) + INDEX_HEAD.size
+        while pos < len(data):
+            z, x, y, kind_len, start, length = INDEX_ENTRY.unpack_from(data, pos)
+            pos += INDEX_ENTRY.size
+            index[(z, x, y, data[pos:pos + kind_len].decode())] = (start, length)
+            pos += kind_len
+        self.index = index
+        self.end = end
+
+    def save_index(self):
+        '''Write the offsets of all indexed records next to the pack'''
+        with self.mutex:
+            entries = [INDEX_HEADER, INDEX_HEAD.pack(os.fstat(self.fd).st_ino, self.end)]
+            for (z, x, y, kind), (start, length) in self.index.items():
+                kind_b = kind.encode()
+                entries.append(INDEX_ENTRY.pack(z, x, y, len(kind_b), start, length) + kind_b)
+            tmp = "{}.{}.tmp".format(self.index_file(), os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(b"".join(entries))
+            os.replace(tmp, self.index_file())
+            self.saved = self.end
+
+    def compact(self):
+        '''
+        Rewrite the pack with the latest record of every tile only,
+        returns the number of bytes freed.
+        '''
+        with self.lock():
+            self._refresh(truncate=True)
+            size = len(self.map)
+            tmp = "{}.{}.tmp".format(self.filename, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(PACK_HEADER)
+                for (z, x, y, kind), (start, length) in sorted(self.index.items(), key=lambda item: item[1]):
+                    f.write(self.map[start - RECORD.size - len(kind.encode()):start + length])
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.filename)
+        self.refresh()
+        self.save_index()
+        return size - os.fstat(self.fd).st_size
+
+    def get(self, z, x, y, kind):
+        '''Return the tile data or None'''
+        key = (int(z), int(x), int(y), kind)
+        view = self.view
+        if view is not None:
+            index, map = view
+            found = index.get(key)
+            # records indexed after the view was taken may lie beyond its map
+            if found is not None and found[0] + found[1] <= len(map):
+                return map[found[0]:found[0] + found[1]]
+        with self.mutex:
+            if key not in self.index:
+                self.refresh()
+                if key not in self.index:
+                    return None
+            start, length = self.index[key]
+            return self.map[start:start + length]
+
+    def put(self, z, x, y, kind, data):
+        '''Append a tile to the pack'''
+        kind_b = kind.encode()
+        record = RECORD.pack(RECORD_MAGIC, int(z), int(x), int(y),
+                             len(kind_b), len(data), zlib.crc32(data)) + kind_b + data
+        with self.lock():
+            self.refresh(truncate=True)
+            os.write(self.fd, record)
+        self.refresh()
+
+    def __contains__(self, key):
+        z, x, y, kind = key
+        return self.get(z, x, y, kind) is not None
+
+    def keys(self):
+        with self.mutex:
+            self.refresh()
+            return list(self.index)
+
+
+def open_store(location):
+    '''TilePack for *.pack files, TileDir otherwise'''
+    if location.endswith(".pack"):
+        return TilePack(location)
+    return TileDir(location)
+
+
+# tiles/{z}_{x}_{y}.{kind} of the web service
+flat_tile = re.compile(r"^(\d+)_(\d+)_(\d+)\.(.+)$")
+# tiles/{png,raw,lz4}/{z}/{x}/{y}[_dt].{ext} of download.py
+tree_tile = re.compile(r"(?:^|/)(png|raw|lz4)/(\d+)/(\d+)/(\d+)(_dt)?\.(png|raw|lz4)$")
+
+
+def tree_kind(folder, dithered):
+    if folder == "png":
+        return "dt.png" if dithered else "src.png"
+    return folder
+
+
+def import_dir(pack, root):
+    '''Copy all tiles found below root into pack, returns the number added'''
+    added = 0
+    for folder, _, files in os.walk(root):
+        for name in files:
+            filename = os.path.join(folder, name)
+            m = flat_tile.match(name)
+            if m:
+                z, x, y, kind = m.groups()
+                if kind.endswith(".tmp"):
+                    continue
+            else:
+                m = tree_tile.search(filename.replace(os.sep, "/"))
+                if not m:
+                    continue
+                top, z, x, y, dithered, _ = m.groups()
+                kind = tree_kind(top, dithered)
+            if (int(z), int(x), int(y), kind) in pack.index:
+                continue
+            with open(filename, "rb") as f:
+                pack.put(z, x, y, kind, f.read())
+            added += 1
+    return added
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "import":
+        pack = TilePack(sys.argv[2])
+        for root in sys.argv[3:]:
+            print(root, import_dir(pack, root), "tiles imported")
+        pack.close()
+    elif len(sys.argv) == 3 and sys.argv[1] == "compact":
+        pack = TilePack(sys.argv[2])
+        print(pack.compact(), "bytes freed")
+        pack.close()
+    else:
+        print("usage: tilestore.py import <pack> <tile dir> [<tile dir> ...]")
+        print("       tilestore.py compact <pack>")
+        sys.exit(1)
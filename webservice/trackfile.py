@@ -0,0 +1,162 @@
+"""Track line helpers for the TRACK file of an archive.
+
+The TRACK file is text by default, one "{lon} {lat}" line per point.
+The optional binary format (TRACK.BIN) is little endian:
+
+    header  magic "ITRK", version(B), reserved(B), points per chunk(H),
+            point count(I), chunk count(I), bbox min lon, min lat, max lon, max lat(4i)
+    index   per chunk: data offset(I), first lon, first lat(2i), chunk bbox(4i)
+    data    per chunk: zigzag varint deltas (lon, lat) of all points after the first
+
+Coordinates are fixed point int32 in 1e-7 degrees. The chunk bbox lets a
+reader skip to the chunks inside the visible area without decoding the rest.
+
+    python trackfile.py text2bin <TRACK> <TRACK.BIN>
+    python trackfile.py bin2text <TRACK.BIN> <TRACK>
+"""
+import struct
+import sys
+import numpy
+
+EARTH_RADIUS = 6371000.0
+
+
+def to_meters(lon, lat):
+    '''Project to a local plane in meters (equirectangular around the mean latitude)'''
+    lon = numpy.radians(numpy.asarray(lon, dtype=numpy.float64))
+    lat = numpy.radians(numpy.asarray(lat, dtype=numpy.float64))
+    x = lon * numpy.cos(lat.mean()) * EARTH_RADIUS if len(lat) else lon
+    return x, lat * EARTH_RADIUS
+
+
+def simplify(lon, lat, tolerance):
+    '''
+    Douglas-Peucker simplification of a line.
+    tolerance: maximum distance in meters of a dropped point to the simplified line
+    Returns the indices of the points to keep.
+    '''
+    n = len(lon)
+    if n < 3 or tolerance <= 0:
+        return numpy.arange(n)
+    x, y = to_meters(lon, lat)
+    keep = numpy.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    # all open segments of one recursion level are handled at once
+    first = numpy.array([0])
+    last = numpy.array([n - 1])
+    while len(first):
+        inner = last - first - 1
+        first, last, inner = first[inner > 0], last[inner > 0], inner[inner > 0]
+        if not len(first):
+            break
+        segment = numpy.repeat(numpy.arange(len(first)), inner)
+        starts = numpy.cumsum(inner) - inner
+        points = first[segment] + 1 + numpy.arange(len(segment)) - starts[segment]
+        px = x[points] - x[first][segment]
+        py = y[points] - y[first][segment]
+        dx = (x[last] - x[first])[segment]
+        dy = (y[last] - y[first])[segment]
+        length = dx * dx + dy * dy
+        # distance to the segment, clamped to its end points
+        t = numpy.clip((px * dx + py * dy) / numpy.where(length > 0, length, 1), 0, 1)
+        dist = numpy.hypot(px - t * dx, py - t * dy)
+        peak = numpy.maximum.reduceat(dist, starts)
+        # first point reaching the maximum of each segment
+        at_peak = numpy.flatnonzero(dist == peak[segment])
+        _, first_at = numpy.unique(segment[at_peak], return_index=True)
+        split = points[at_peak[first_at]]
+        far = peak > tolerance
+        keep[split[far]] = True
+        first, last = (numpy.concatenate([first[far], split[far]]),
+                       numpy.concatenate([split[far], last[far]]))
+    return numpy.flatnonzero(keep)
+
+
+MAGIC = b"ITRK"
+VERSION = 1
+SCALE = 10000000
+HEADER = struct.Struct("<4sBBHII4i")
+INDEX = struct.Struct("<I2i4i")
+
+
+def encode_text(lon, lat):
+    return "".join("{} {}\n".format(x, y) for x, y in zip(lon, lat)).encode()
+
+
+def decode_text(data):
+    values = numpy.array(data.split(), dtype=numpy.float64).reshape(-1, 2)
+    return values[:, 0], values[:, 1]
+
+
+def _varint(value, out):
+    # zigzag, then 7 bits per byte
+    value = (value << 1) ^ (value >> 63)
+    value &= 0xffffffffffffffff
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_binary(lon, lat, chunk=64):
+    lon = numpy.round(numpy.asarray(lon, dtype=numpy.float64) * SCALE).astype(numpy.int64)
+    lat = numpy.round(numpy.asarray(lat, dtype=numpy.float64) * SCALE).astype(numpy.int64)
+    count = len(lon)
+    chunks = (count + chunk - 1) // chunk
+    bbox = (int(lon.min()), int(lat.min()), int(lon.max()), int(lat.max())) if count else (0, 0, 0, 0)
+    index = bytearray()
+    data = bytearray()
+    for start in range(0, count, chunk):
+        x = lon[start:start + chunk]
+        y = lat[start:start + chunk]
+        index += INDEX.pack(len(data), int(x[0]), int(y[0]),
+                            int(x.min()), int(y.min()), int(x.max()), int(y.max()))
+        for dx, dy in zip(numpy.diff(x).tolist(), numpy.diff(y).tolist()):
+            _varint(dx, data)
+            _varint(dy, data)
+    return HEADER.pack(MAGIC, VERSION, 0, chunk, count, chunks, *bbox) + bytes(index) + bytes(data)
+
+
+def decode_binary(data):
+    magic, version, _, chunk, count, chunks, *_ = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a binary TRACK file")
+    base = HEADER.size + chunks * INDEX.size
+    lon = numpy.zeros(count, dtype=numpy.int64)
+    lat = numpy.zeros(count, dtype=numpy.int64)
+    for c in range(chunks):
+        offset, x, y, *_ = INDEX.unpack_from(data, HEADER.size + c * INDEX.size)
+        pos = base + offset
+        start = c * chunk
+        for i in range(start, min(start + chunk, count)):
+            if i > start:
+                deltas = []
+                for _ in range(2):
+                    value = shift = 0
+                    while True:
+                        b = data[pos]
+                        pos += 1
+                        value |= (b & 0x7f) << shift
+                        shift += 7
+                        if b < 0x80:
+                            break
+                    deltas.append((value >> 1) ^ -(value & 1))
+                x += deltas[0]
+                y += deltas[1]
+            lon[i] = x
+            lat[i] = y
+    return lon / SCALE, lat / SCALE
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] not in ("text2bin", "bin2text"):
+        print("usage: trackfile.py text2bin|bin2text <in> <out>")
+        sys.exit(1)
+    with open(sys.argv[2], "rb") as f:
+        data = f.read()
+    if sys.argv[1] == "text2bin":
+        out = encode_binary(*decode_text(data))
+    else:
+        out = encode_text(*(a.tolist() for a in decode_binary(data)))
+    with open(sys.argv[3], "wb") as f:
+        f.write(out)
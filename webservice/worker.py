@@ -0,0 +1,118 @@
+"""Worker for archive jobs queued by the web service.
+
+    python worker.py [--concurrency N] [--visibility SECONDS] [--retries N] [--queue NAME]
+
+Jobs run in a process pool, one job per process. The leases of running
+jobs are renewed while their done counter moves, jobs of a crashed worker
+and hanging jobs are picked up again once their lease expired and resume
+at their done counter. An expiry counts as a failed attempt.
+SIGTERM/SIGINT stop taking new jobs and wait for the running ones,
+a second signal exits at once.
+"""
+import argparse
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import api
+import database
+from jobqueue import JobQueue
+
+
+def run_job(id):
+    api.run_download_task(id)
+
+
+def finish(queue, id, error):
+    if error is None:
+        queue.ack(id)
+        return
+    print("Job", id, "failed:", repr(error))
+    if not queue.fail(id):
+        print("Job", id, "gave up")
+        database.Job(id)['status'] = "failed"
+
+
+def work(queue, concurrency):
+    stopping = []
+
+    def stop(signum, frame):
+        if stopping:
+            sys.exit(1)
+        print("Stopping, waiting for", len(running), "jobs")
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    running = {}
+    # done counter of each running job at its last lease renewal
+    progress = {}
+    # running jobs whose lease expired
+    expired = set()
+    pool = ProcessPoolExecutor(max_workers=concurrency)
+    renewed = 0
+    while running or not stopping:
+        if len(running) < concurrency and not stopping:
+            id = queue.reserve(timeout=1)
+            if id is not None:
+                print("Job", id, "started")
+                running[pool.submit(run_job, id)] = id
+        else:
+            wait(running, timeout=1, return_when=FIRST_COMPLETED)
+
+        broken = False
+        for future in [f for f in running if f.done()]:
+            id = running.pop(future)
+            progress.pop(future, None)
+            error = future.exception()
+            broken = broken or isinstance(error, BrokenProcessPool)
+            if future in expired:
+                # the queue took the job back already
+                expired.remove(future)
+                print("Job", id, "ended after its lease expired")
+                continue
+            finish(queue, id, error)
+        if broken:
+            # a job process died, the pool can not be used anymore
+            pool.shutdown(wait=False)
+            pool = ProcessPoolExecutor(max_workers=concurrency)
+
+        if time.time() - renewed > queue.visibility / 3:
+            # only jobs that converted tiles since the last pass keep their
+            # lease, a hanging one expires and counts as a failed attempt
+            for future, id in running.items():
+                if future in expired:
+                    continue
+                done = database.Job(id)['done']
+                if progress.get(future) != done:
+                    progress[future] = done
+                    queue.extend(id)
+                else:
+                    print("Job", id, "made no progress")
+            for id, retry in queue.requeue_expired().items():
+                # a process of this worker may still run it, it is left alone
+                expired.update(future for future, running_id in running.items() if running_id == id)
+                if retry:
+                    print("Job", id, "lease expired, queued again")
+                else:
+                    print("Job", id, "lease expired, gave up")
+                    database.Job(id)['status'] = "failed"
+            renewed = time.time()
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run archive jobs from the redis queue")
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("WORKER_CONCURRENCY", os.cpu_count())),
+                        help="jobs running at the same time")
+    parser.add_argument("--visibility", type=float, default=float(os.environ.get("WORKER_VISIBILITY", 300)),
+                        help="seconds until a job of a dead worker is run again")
+    parser.add_argument("--retries", type=int, default=int(os.environ.get("WORKER_RETRIES", 3)),
+                        help="attempts per job")
+    parser.add_argument("--queue", default="jobs")
+    args = parser.parse_args()
+    work(JobQueue(args.queue, args.visibility, args.retries), args.concurrency)